@@ -73,4 +73,4 @@ CREATE TABLE stat
     method  VARCHAR(80) NOT NULL CHECK (method IN ('GET', 'POST', 'DELETE')),
     count   INT         NOT NULL DEFAULT 0,
     UNIQUE(service, method, path)
-)
+);
@@ -0,0 +1,198 @@
+import argparse
+import logging
+import os
+import sys
+import time
+
+import psycopg2
+from tabulate import tabulate
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'services'))
+
+import tools
+from migrator import MigrationRunner
+
+SCHEMA = 'index_benchmark'
+MIGRATION_SETS = ['flights', 'tickets', 'privileges']
+
+TABLES = [
+    'CREATE TABLE flight '
+    '( '
+    '    id              SERIAL PRIMARY KEY, '
+    '    number          VARCHAR(20)              NOT NULL, '
+    '    datetime        TIMESTAMP WITH TIME ZONE NOT NULL, '
+    '    from_airport_id INT, '
+    '    to_airport_id   INT, '
+    '    price           INT                      NOT NULL '
+    ')',
+
+    'CREATE TABLE ticket '
+    '( '
+    '    id            SERIAL PRIMARY KEY, '
+    '    uid           uuid UNIQUE NOT NULL, '
+    '    username      VARCHAR(80) NOT NULL, '
+    '    flight_number VARCHAR(20) NOT NULL, '
+    '    price         INT         NOT NULL, '
+    '    status        VARCHAR(20) NOT NULL '
+    ')',
+
+    'CREATE TABLE privilege_history '
+    '( '
+    '    id             SERIAL PRIMARY KEY, '
+    '    privilege_id   INT         NOT NULL, '
+    '    ticket_uid     uuid        NOT NULL, '
+    '    datetime       TIMESTAMP   NOT NULL, '
+    '    balance_diff   INT         NOT NULL, '
+    '    operation_type VARCHAR(20) NOT NULL '
+    ')'
+]
+
+
+def fill_queries(rows):
+    users = max(rows // 10, 1)
+    flights = max(rows // 100, 1)
+
+    return [
+        f'INSERT INTO flight(number, datetime, from_airport_id, to_airport_id, price) '
+        f'    SELECT \'AFL\' || i, now(), 1, 2, 1500 FROM generate_series(1, {rows}) i',
+
+        f'INSERT INTO ticket(uid, username, flight_number, price, status) '
+        f'    SELECT md5(i::text)::uuid, \'user\' || (i % {users}), \'AFL\' || (i % {flights}), 1500, '
+        f'        CASE WHEN i % 5 = 0 THEN \'CANCELED\' ELSE \'PAID\' END '
+        f'    FROM generate_series(1, {rows}) i',
+
+        f'INSERT INTO privilege_history(privilege_id, ticket_uid, datetime, balance_diff, operation_type) '
+        f'    SELECT i % {users}, md5(i::text)::uuid, now(), 150, \'FILL_IN_BALANCE\' '
+        f'    FROM generate_series(1, {rows}) i'
+    ]
+
+
+BENCHMARK_QUERIES = [
+    (
+        'TicketDbConnector.get_user_tickets',
+        'SELECT uid, flight_number, price, status FROM ticket WHERE username = \'user42\''
+    ),
+    (
+        'TicketDbConnector.get_flight_tickets_count',
+        'SELECT COUNT(*) FROM ticket WHERE flight_number = \'AFL42\' AND status = \'PAID\''
+    ),
+    (
+        'FlightDbConnector.get_flight_by_number',
+        'SELECT id, number, datetime, price FROM flight WHERE number = \'AFL42\''
+    ),
+    (
+        'BonusDbConnector.get_privilege_history',
+        'SELECT id, ticket_uid, datetime, balance_diff, operation_type FROM privilege_history '
+        'WHERE privilege_id = 42 ORDER BY id LIMIT 100'
+    ),
+    (
+        'BonusDbConnector.get_privilege_history_by_ticket',
+        'SELECT id, privilege_id, balance_diff, operation_type FROM privilege_history '
+        'WHERE ticket_uid = md5(\'42\')::uuid'
+    )
+]
+
+
+def find_scans(plan):
+    scans = []
+
+    if 'Scan' in plan['Node Type']:
+        scans.append(plan['Node Type'])
+
+    for child in plan.get('Plans', []):
+        scans += find_scans(child)
+
+    return scans
+
+
+def explain(cursor, query):
+    cursor.execute(f'EXPLAIN (ANALYZE, FORMAT JSON) {query}')
+    result = cursor.fetchone()[0][0]
+
+    return ', '.join(find_scans(result['Plan'])), result['Execution Time']
+
+
+def run(connection, rows):
+    cursor = connection.cursor()
+
+    for name in MIGRATION_SETS:
+        cursor.execute(f'DROP SCHEMA IF EXISTS {SCHEMA}_{name} CASCADE')
+
+    cursor.execute(f'DROP SCHEMA IF EXISTS {SCHEMA} CASCADE')
+    cursor.execute(f'CREATE SCHEMA {SCHEMA}')
+    cursor.execute(f'SET search_path TO {SCHEMA}')
+
+    for query in TABLES:
+        cursor.execute(tools.simplify_sql_query(query))
+
+    start_time = time.monotonic()
+    for query in fill_queries(rows):
+        cursor.execute(tools.simplify_sql_query(query))
+
+    cursor.execute('ANALYZE')
+    connection.commit()
+
+    print(f'Filled {rows} rows per table in {time.monotonic() - start_time:.1f}s')
+
+    before = [explain(cursor, query) for _, query in BENCHMARK_QUERIES]
+
+    # each service database keeps its own schema_migration table, emulate that with a schema per migration set
+    logger = logging.getLogger('benchmark')
+    for name in MIGRATION_SETS:
+        cursor.execute(f'CREATE SCHEMA {SCHEMA}_{name}')
+        cursor.execute(f'SET search_path TO {SCHEMA}_{name}, {SCHEMA}')
+        connection.commit()
+
+        MigrationRunner(logger, name).apply(connection)
+
+    cursor.execute(f'SET search_path TO {SCHEMA}')
+    cursor.execute('ANALYZE')
+    connection.commit()
+
+    after = [explain(cursor, query) for _, query in BENCHMARK_QUERIES]
+
+    print(
+        tabulate(
+            [
+                [name, before_plan, f'{before_ms:.2f}', after_plan, f'{after_ms:.2f}']
+                for (name, _), (before_plan, before_ms), (after_plan, after_ms) in zip(BENCHMARK_QUERIES, before, after)
+            ],
+            headers=['query', 'plan before', 'ms before', 'plan after', 'ms after']
+        )
+    )
+
+    for name in MIGRATION_SETS:
+        cursor.execute(f'DROP SCHEMA {SCHEMA}_{name} CASCADE')
+
+    cursor.execute(f'DROP SCHEMA {SCHEMA} CASCADE')
+    connection.commit()
+
+    cursor.close()
+
+
+if __name__ == '__main__':
+    tools.set_basic_logging_config(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='compare hot query plans before and after the index migrations')
+    parser.add_argument('--db-host', type=str, default='localhost')
+    parser.add_argument('--db-port', type=int, default=5432)
+    parser.add_argument('--db', type=str, default='postgres')
+    parser.add_argument('--db-user', type=str, required=True)
+    parser.add_argument('--db-password', type=str, required=True)
+    parser.add_argument('--rows', type=int, default=1_000_000)
+
+    cmd_args = parser.parse_args()
+
+    connection = psycopg2.connect(
+        host=cmd_args.db_host,
+        port=cmd_args.db_port,
+        database=cmd_args.db,
+        user=cmd_args.db_user,
+        password=cmd_args.db_password
+    )
+
+    try:
+        run(connection, cmd_args.rows)
+
+    finally:
+        connection.close()
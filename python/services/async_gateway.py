@@ -0,0 +1,333 @@
+import logging
+
+import asyncio
+import json
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import aiohttp
+from aiohttp import web
+
+from errors import UserError, ServerError
+from upstream import RequestBackup
+from metrics import PrometheusText
+
+ALL_METHODS = ['GET', 'POST', 'DELETE']
+
+HOP_BY_HOP_HEADERS = {
+    'connection',
+    'keep-alive',
+    'proxy-authenticate',
+    'proxy-authorization',
+    'te',
+    'trailers',
+    'transfer-encoding',
+    'upgrade',
+    'host',
+    'content-length'
+}
+
+
+class AsyncGateway:
+    def __init__(
+        self,
+        gateway,
+        upstream_pool_size=1024,
+        upstream_connect_timeout_s=3,
+        upstream_read_timeout_s=30,
+        blocking_workers=32,
+        chunk_size=64 * 1024
+    ):
+        self._gateway = gateway
+
+        self._upstream_pool_size = upstream_pool_size
+        self._upstream_timeout = aiohttp.ClientTimeout(
+            sock_connect=upstream_connect_timeout_s,
+            sock_read=upstream_read_timeout_s
+        )
+        self._chunk_size = chunk_size
+
+        self._blocking_executor = ThreadPoolExecutor(max_workers=blocking_workers)
+        self._sessions = {}
+
+        self._logger = logging.getLogger(f'{gateway._service_name} async')
+
+        self._app = web.Application()
+        self._app.on_cleanup.append(self._on_cleanup)
+
+        self._register_routes()
+
+    def run(self, backlog=1024):
+        self._logger.info(f'Run async gateway on http://{self._gateway._host}:{self._gateway._port}')
+
+        self._gateway._start_metrics_reporter()
+
+        web.run_app(self._app, host=self._gateway._host, port=self._gateway._port, backlog=backlog, print=None)
+
+        self._logger.info(f'End async gateway run')
+
+    # Routes
+    ####################################################################################################################
+
+    def _register_routes(self):
+        gateway = self._gateway
+
+        self._add_route('/manage/health', ['GET'], self._manage_health, event_path=None)
+        self._add_route('/manage/metrics', ['GET'], self._manage_metrics, event_path=None)
+
+        self._add_proxy_route('/api/v1/flights', '/api/v1/flights', gateway._flight_service_info)
+        self._add_proxy_route('/api/v1/flights/<path:path>', '/api/v1/flights/{path:.*}', gateway._flight_service_info)
+        self._add_proxy_route('/api/v1/privilege', '/api/v1/privilege', gateway._bonus_service_info)
+        self._add_proxy_route('/api/v1/privilege/<path:path>', '/api/v1/privilege/{path:.*}', gateway._bonus_service_info)
+        self._add_proxy_route('/api/v1/tickets', '/api/v1/tickets', gateway._ticket_service_info)
+        self._add_proxy_route('/api/v1/tickets/<path:path>', '/api/v1/tickets/{path:.*}', gateway._ticket_service_info)
+        self._add_proxy_route('/api/v1/me', '/api/v1/me', gateway._ticket_service_info)
+
+        self._add_route('/api/v1/stats', ['GET'], self._stats)
+        self._add_route('/api/v1/stats/latency', ['GET'], self._stats)
+        self._add_route('/api/v1/authorize', ['POST'], self._authorize)
+        self._add_route('/api/v1/register', ['POST'], self._register)
+        self._add_route('/api/v1/callback', ALL_METHODS, self._callback)
+
+    def _add_proxy_route(self, event_path, path, service_info):
+        async def handler(request):
+            return await self._resend(service_info, request)
+
+        self._add_route(path, ALL_METHODS, handler, event_path)
+
+    def _add_route(self, path, methods, handler, event_path=''):
+        if event_path == '':
+            event_path = path
+
+        async def wrapper(request):
+            self._logger.debug(f'Call handler for path: {path}')
+
+            start_time = time.perf_counter()
+            error_class = ''
+
+            try:
+                response = await handler(request)
+
+            except UserError as error:
+                error_class = type(error).__name__
+
+                response = web.json_response(error.message, status=error.code)
+
+            except ServerError as error:
+                self._logger.error(f'Server internal error: {error.message["message"]} with code {error.code}')
+                error_class = type(error).__name__
+
+                response = web.json_response({'message': 'internal error'}, status=error.code)
+
+            except Exception as error:
+                self._logger.error(f'Unknown internal error: {error}')
+                error_class = type(error).__name__
+
+                response = web.json_response({'message': 'internal error'}, status=500)
+
+            if event_path is not None:
+                latency_s = time.perf_counter() - start_time
+
+                self._gateway._request_metrics.record(request.method, event_path, latency_s, response.status, error_class)
+                self._gateway._send_request_event(request.method, event_path, latency_s, response.status)
+
+            return response
+
+        self._logger.info(f'Register route for \'{path}\' with methods: {methods}')
+
+        for method in methods:
+            self._app.router.add_route(method, path, wrapper)
+
+    # Handlers
+    ####################################################################################################################
+
+    async def _manage_health(self, request):
+        return web.Response()
+
+    async def _manage_metrics(self, request):
+        return web.Response(
+            text=self._gateway._render_metrics(),
+            headers={'Content-Type': PrometheusText.content_type}
+        )
+
+    async def _stats(self, request):
+        await self._run_blocking(self._gateway._check_admin, self._request_view(request), 'only admin user can view stats')
+
+        return await self._resend(self._gateway._stats_service_info, request, authorized=True)
+
+    async def _authorize(self, request):
+        body = await self._read_json(request)
+
+        return web.Response(text=await self._run_blocking(self._gateway._authorize_user, body), content_type='text/html')
+
+    async def _register(self, request):
+        await self._run_blocking(self._gateway._check_admin, self._request_view(request), 'only admin user can register')
+
+        body = await self._read_json(request)
+
+        return web.Response(text=await self._run_blocking(self._gateway._register_user, body), content_type='text/html')
+
+    async def _callback(self, request):
+        return web.Response()
+
+    # Proxy
+    ####################################################################################################################
+
+    async def _resend(self, service_info, request, authorized=False):
+        if not authorized:
+            await self._run_blocking(self._gateway._check_authorization, self._request_view(request))
+
+        data = await request.read()
+        headers = self._filter_headers(request.headers)
+
+        try:
+            if len(service_info.queue) != 0:
+                if not await self._check_service_health(service_info):
+                    raise RuntimeError('Service is unavailable')
+
+                for request_backup in list(service_info.queue):
+                    response = await self._send(
+                        service_info,
+                        request_backup.method,
+                        request_backup.path,
+                        request_backup.headers,
+                        request_backup.args,
+                        request_backup.data
+                    )
+                    response.release()
+
+                    service_info.queue.remove(request_backup)
+
+            upstream_response = await self._send(
+                service_info,
+                request.method,
+                request.rel_url.raw_path,
+                headers,
+                request.query,
+                data
+            )
+
+        except Exception:
+            if request.method == 'DELETE':
+                service_info.queue.append(
+                    RequestBackup(request.rel_url.raw_path, request.method, headers, dict(request.query), data)
+                )
+
+                return web.Response()
+
+            raise ServerError()
+
+        return await self._stream(request, upstream_response)
+
+    async def _send(self, service_info, method, path, headers, args, data):
+        try:
+            self._logger.debug('Send request')
+
+            response = await self._get_session(service_info).request(
+                method,
+                f'{service_info.url}{path}',
+                headers=headers,
+                params=args,
+                data=data
+            )
+
+            service_info.on_success()
+            self._logger.debug(f'Got response from service, reset error level to 0')
+
+            return response
+
+        except Exception as error:
+            self._logger.error(f'Failed to send request, error: {error}')
+
+            service_info.on_failure(self._gateway._valid_error_level)
+            self._logger.debug(f'Error level: {service_info.error_level}')
+
+            raise
+
+    async def _stream(self, request, upstream_response):
+        response = web.StreamResponse(
+            status=upstream_response.status,
+            headers=self._filter_headers(upstream_response.headers)
+        )
+
+        try:
+            await response.prepare(request)
+
+            async for chunk in upstream_response.content.iter_chunked(self._chunk_size):
+                await response.write(chunk)
+
+            await response.write_eof()
+
+        except Exception as error:
+            self._logger.error(f'Failed to stream response, error: {error}')
+
+        finally:
+            upstream_response.release()
+
+        return response
+
+    async def _check_service_health(self, service_info):
+        valid_error_level = self._gateway._valid_error_level
+        wait_before_retry = self._gateway._wait_before_retry
+
+        if service_info.is_circuit_open(valid_error_level, wait_before_retry):
+            self._logger.error(
+                f'Failed to send request to {service_info.url}, '
+                f'error level {service_info.error_level} > {valid_error_level} '
+                f'for {wait_before_retry}s from last {service_info.last_error_time}'
+            )
+
+            return False
+
+        try:
+            async with self._get_session(service_info).get(f'{service_info.url}/manage/health'):
+                pass
+
+        except Exception:
+            return False
+
+        return True
+
+    # Helpers
+    ####################################################################################################################
+
+    async def _on_cleanup(self, app):
+        for session in self._sessions.values():
+            await session.close()
+
+    def _get_session(self, service_info):
+        session = self._sessions.get(service_info.url)
+
+        if session is None:
+            session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self._upstream_pool_size),
+                timeout=self._upstream_timeout,
+                auto_decompress=False
+            )
+            self._sessions[service_info.url] = session
+
+        return session
+
+    async def _run_blocking(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._blocking_executor, func, *args)
+
+    @staticmethod
+    async def _read_json(request):
+        try:
+            return await request.json()
+
+        except json.JSONDecodeError:
+            raise UserError('invalid json body')
+
+    @staticmethod
+    def _request_view(request):
+        return SimpleNamespace(
+            method=request.method,
+            headers={key.title(): value for key, value in request.headers.items()}
+        )
+
+    @staticmethod
+    def _filter_headers(headers):
+        return {key: value for key, value in headers.items() if key.lower() not in HOP_BY_HOP_HEADERS}
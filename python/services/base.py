@@ -5,23 +5,268 @@ from flask import request
 import logging
 
 import psycopg2
+import psycopg2.extensions
 
 from errors import UserError, ServerError
 from getters import ServerValue, UserValue
+import tools
+from cache import TtlLruCache
+from events import EventEmitter
+from telemetry import EventEncoder
+import routes
+from migrator import MigrationRunner
+from metrics import RequestMetrics, TimingMetrics, PrometheusText, METRICS_TOPIC
 
 from datetime import datetime
 import time
 
+import queue
+import select
+import threading
+import functools
+import json
+import base64
+import re
+import hashlib
+import hmac
+from contextlib import contextmanager
+
 from keycloak import KeycloakOpenID
-from keycloak.keycloak_openid import jwt
+from keycloak.keycloak_openid import jwt, jwk
 
 from kafka import KafkaProducer
 
+class DbConnectionPool:
+    def __init__(self, logger, connect, min_size, max_size, checkout_timeout_s, health_check_interval_s):
+        assert 0 <= min_size <= max_size and max_size > 0
+
+        self._logger = logger
+        self._connect = connect
+        self._checkout_timeout_s = checkout_timeout_s
+        self._health_check_interval_s = health_check_interval_s
+
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._idle = queue.LifoQueue()
+        self._last_used = {}
+
+        self._logger.info(f'Create connection pool with min size {min_size} and max size {max_size}')
+
+        # the database may still be starting together with the service, so the first connections retry
+        for i in range(min_size):
+            self._release_idle(self._connect(retry_number=10))
+
+    def get(self):
+        if not self._slots.acquire(timeout=self._checkout_timeout_s):
+            raise ServerError('database connection pool exhausted', 503)
+
+        try:
+            while True:
+                try:
+                    connection = self._idle.get_nowait()
+                except queue.Empty:
+                    return self._reconnect()
+
+                if self._is_healthy(connection):
+                    return connection
+
+                self._logger.warning('Drop broken database connection, reconnecting')
+                self._close(connection)
+
+        except BaseException:
+            self._slots.release()
+
+            raise
+
+    def put(self, connection, broken=False):
+        try:
+            if broken or connection.closed:
+                self._close(connection)
+                return
+
+            try:
+                if connection.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    connection.rollback()
+
+            except psycopg2.Error as error:
+                self._logger.warning(f'Failed to reset database connection, error: {error}')
+                self._close(connection)
+                return
+
+            self._release_idle(connection)
+
+        finally:
+            self._slots.release()
+
+    def close_idle(self):
+        while True:
+            try:
+                self._close(self._idle.get_nowait())
+            except queue.Empty:
+                return
+
+    def _reconnect(self):
+        # a request must not hold a slot while waiting for the database to come back
+        try:
+            return self._connect(retry_number=1)
+
+        except Exception as error:
+            self._logger.error(f'Failed to connect to database, error: {error}')
+
+            raise ServerError('database unavailable', 503)
+
+    def _release_idle(self, connection):
+        self._last_used[id(connection)] = time.monotonic()
+        self._idle.put(connection)
+
+    def _is_healthy(self, connection):
+        if connection.closed:
+            return False
+
+        # an idle connection has nothing to read unless the server closed it or sent a fatal error
+        if len(select.select([connection.fileno()], [], [], 0)[0]) != 0:
+            return False
+
+        if time.monotonic() - self._last_used.get(id(connection), 0) < self._health_check_interval_s:
+            return True
+
+        try:
+            cursor = connection.cursor()
+            cursor.execute('SELECT 1')
+            cursor.close()
+            connection.rollback()
+
+        except psycopg2.Error:
+            return False
+
+        return True
+
+    def _close(self, connection):
+        self._last_used.pop(id(connection), None)
+
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+
+
+class PreparedStatement:
+    def __init__(self, name, query):
+        self.name = name
+        self.query = tools.simplify_sql_query(query)
+
+        self.prepare_query = f'PREPARE {name} AS {self.query}'
+
+        parameters_count = max((int(index) for index in re.findall(r'\$(\d+)', self.query)), default=0)
+        if parameters_count == 0:
+            self.execute_query = f'EXECUTE {name}'
+        else:
+            self.execute_query = f'EXECUTE {name}({", ".join(["%s"] * parameters_count)})'
+
+
+class PreparingConnection(psycopg2.extensions.connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.prepared_statements = set()
+
+
 class DbConnectorBase:
-    def __init__(self, name, host, port, database, user, password, sslmode):
+    migrations = None
+
+    # name -> query with $1, $2, ... bind parameters, prepared once per connection
+    statements = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+
+        for name, method in list(cls.__dict__.items()):
+            if not name.startswith('_') and callable(method):
+                setattr(cls, name, DbConnectorBase._timed(name, method))
+
+        cls.statements = {
+            name: PreparedStatement(f'{cls.__name__.lower()}_{name}', query)
+            for name, query in cls.__dict__.get('statements', {}).items()
+        }
+
+    @staticmethod
+    def _timed(name, method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            start_time = time.perf_counter()
+
+            try:
+                return method(self, *args, **kwargs)
+
+            finally:
+                self.query_timings.record(name, time.perf_counter() - start_time)
+
+        return wrapper
+
+    def __init__(
+        self,
+        name,
+        host,
+        port,
+        database,
+        user,
+        password,
+        sslmode,
+        pool_min=1,
+        pool_max=10,
+        pool_checkout_timeout_s=5,
+        pool_health_check_interval_s=30
+    ):
         self._logger = logging.getLogger(name)
 
-        self._connection = self.create_connection(host, port, database, user, password, sslmode)
+        self.query_timings = TimingMetrics()
+
+        self._pool = DbConnectionPool(
+            self._logger,
+            lambda retry_number: self.create_connection(host, port, database, user, password, sslmode, retry_number),
+            pool_min,
+            pool_max,
+            pool_checkout_timeout_s,
+            pool_health_check_interval_s
+        )
+
+        if self.migrations is not None:
+            self.apply_migrations()
+
+    def apply_migrations(self):
+        with self._connection() as connection:
+            MigrationRunner(self._logger, self.migrations).apply(connection)
+
+    @contextmanager
+    def _connection(self):
+        connection = self._pool.get()
+        broken = False
+
+        try:
+            yield connection
+
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+
+            raise
+
+        finally:
+            self._pool.put(connection, broken)
+
+    def _execute(self, cursor, statement_name, parameters=()):
+        statement = self.statements[statement_name]
+        prepared_statements = cursor.connection.prepared_statements
+
+        if statement.name not in prepared_statements:
+            self._logger.debug(f'Prepare statement: {statement.query}')
+
+            cursor.execute(statement.prepare_query)
+            prepared_statements.add(statement.name)
+
+        self._logger.debug(f'Execute statement {statement.name} with: {parameters}')
+        cursor.execute(statement.execute_query, parameters)
+
+    def close_idle_connections(self):
+        self._pool.close_idle()
 
     def create_connection(self, host, port, database, user, password, sslmode, retry_number=10, reconnecting_delay_s=1):
         self._logger.info(
@@ -29,6 +274,9 @@ class DbConnectorBase:
         )
 
         for i in range(retry_number):
+            if i != 0:
+                time.sleep(reconnecting_delay_s)
+
             try:
                 return psycopg2.connect(
                     host=host,
@@ -36,42 +284,91 @@ class DbConnectorBase:
                     database=database,
                     user=user,
                     password=password,
-                    sslmode=sslmode
+                    sslmode=sslmode,
+                    connection_factory=PreparingConnection
                 )
             except Exception as exception:
                 error = exception.args[0].replace('\n', ' ').strip()
-                if error.find('Connection refused'):
-                    logging.debug(f'Got error {error}, reconnecting in {reconnecting_delay_s} seconds')
-                    time.sleep(reconnecting_delay_s)
+                logging.debug(f'Got error {error} on attempt {i + 1} of {retry_number}')
         
         raise RuntimeError('Connection to database failed')
 
 
 class ServiceBase:
-    def __init__(self, name, host, port, db_connector:DbConnectorBase=None, kafka_producer:KafkaProducer=None):
+    metrics_report_interval_s = 10
+    events_close_timeout_s = 5
+
+    event_buffer_size = 10000
+    event_batch_size = 500
+    event_linger_s = 0.05
+    route_announce_interval_s = 60
+
+    manage_token_header = 'X-Manage-Token'
+
+    def __init__(
+        self,
+        name,
+        host,
+        port,
+        db_connector:DbConnectorBase=None,
+        kafka_producer:KafkaProducer=None,
+        manage_token=None
+    ):
         self._service_name = name
 
         self._host = host
         self._port = port
         self._db_connector = db_connector
         self._kafka_producer = kafka_producer
+        self._manage_token = manage_token
+        self._event_emitter = self._create_event_emitter()
+        self._event_encoder = EventEncoder(self.route_announce_interval_s)
 
         self._flask_app = Flask(f'{self._service_name} flask')
 
         self._logger = logging.getLogger(self._service_name)
 
+        self._caches = {}
+        self._upstreams = {}
+
+        self._request_metrics = RequestMetrics()
+        self._metrics_reporter = None
+        self._metrics_reporter_stop = threading.Event()
+
         self._register_manage_health()
+        self._register_manage_metrics()
+        self._register_manage_cache()
+        self._register_manage_upstreams()
         self._register_routes()
 
-    def run(self, debug=False):
+    def run(self, debug=False, server='flask', workers=1, threads=1, backlog=2048, graceful_timeout_s=30):
         self._logger.info(f'Run service on http://{self._host}:{self._port}')
 
         try:
-            self._logger.info(f'Run flask app: host: {self._host}, port: {self._port}, debug: {debug}')
+            if server == 'gunicorn':
+                self._logger.info(
+                    f'Run gunicorn: host: {self._host}, port: {self._port}, '
+                    f'workers: {workers}, threads: {threads}, backlog: {backlog}'
+                )
 
-            self._flask_app.run(self._host, self._port, debug=debug, use_reloader=False)
+                self._run_gunicorn(workers, threads, backlog, graceful_timeout_s)
 
-            self._logger.info(f'End flask app run')
+                self._logger.info(f'End gunicorn run')
+            else:
+                self._start_metrics_reporter()
+
+                self._logger.info(f'Run flask app: host: {self._host}, port: {self._port}, debug: {debug}')
+
+                self._flask_app.run(self._host, self._port, debug=debug, use_reloader=False, threaded=True)
+
+                self._logger.info(f'End flask app run')
+
+        except SystemExit as exit:
+            # gunicorn arbiter and workers end with SystemExit, a zero code is a clean shutdown
+            if exit.code not in (None, 0):
+                self._logger.error(f'Failed while run flask app, exit code: {exit.code}')
+
+                raise
 
         except Exception as exception:
             self._logger.error(f'Failed while run flask app, error: {exception}')
@@ -81,10 +378,75 @@ class ServiceBase:
             self._logger.error(f'Failed while run flask app, with unknown error')
 
             raise
-            
+
+        finally:
+            self._close_events()
 
         self._logger.info(f'End service run')
 
+    def _run_gunicorn(self, workers, threads, backlog, graceful_timeout_s):
+        from gunicorn.app.base import BaseApplication
+
+        service = self
+        options = {
+            'bind': f'{self._host}:{self._port}',
+            'workers': workers,
+            'threads': threads,
+            'worker_class': 'gthread',
+            'backlog': backlog,
+            'graceful_timeout': graceful_timeout_s,
+            'pre_fork': lambda server, worker: service._before_fork(),
+            'post_fork': lambda server, worker: service._after_fork(),
+            'worker_exit': lambda server, worker: service._on_worker_exit()
+        }
+
+        class Application(BaseApplication):
+            def load_config(self):
+                for key, value in options.items():
+                    self.cfg.set(key, value)
+
+            def load(self):
+                return service._flask_app
+
+        Application().run()
+
+    def _before_fork(self):
+        # connections opened in the master process must not be shared with workers
+        if self._db_connector is not None:
+            self._db_connector.close_idle_connections()
+
+    def _after_fork(self):
+        # producer sender thread does not survive fork, so each worker needs its own producer
+        if self._kafka_producer is not None:
+            # producer config also holds derived values such as compression_attrs, which the constructor rejects
+            self._kafka_producer = KafkaProducer(
+                **{
+                    key: value for key, value in self._kafka_producer.config.items()
+                    if key in KafkaProducer.DEFAULT_CONFIG
+                }
+            )
+            self._event_emitter = self._create_event_emitter()
+
+        self._request_metrics = RequestMetrics()
+        self._start_metrics_reporter()
+
+    def _on_worker_exit(self):
+        self._close_events()
+
+    def _close_events(self):
+        # pending events and the last metrics report are sent before the producer goes away
+        self._stop_metrics_reporter()
+
+        if self._event_emitter is not None:
+            self._event_emitter.close(self.events_close_timeout_s)
+
+        if self._kafka_producer is not None:
+            try:
+                self._kafka_producer.close(timeout=self.events_close_timeout_s)
+
+            except Exception as error:
+                self._logger.error(f'Failed to close kafka producer: {error}')
+
     def _manage_health(self):
         return make_response()
     
@@ -100,6 +462,199 @@ class ServiceBase:
             methods=methods
         )
 
+    def _manage_metrics(self):
+        response = make_response(self._render_metrics(), 200)
+        response.headers['Content-Type'] = PrometheusText.content_type
+
+        return response
+
+    def _render_metrics(self):
+        text = PrometheusText()
+
+        histograms, outcomes = self._request_metrics.snapshot()
+
+        text.metric('http_requests_total', 'counter', 'Handled requests by route and outcome')
+        for (method, path, status, error), count in sorted(outcomes.items()):
+            text.sample(
+                'http_requests_total',
+                {'service': self._service_name, 'method': method, 'path': path, 'status': status, 'error': error},
+                count
+            )
+
+        text.metric('http_request_duration_seconds', 'histogram', 'Handler latency by route')
+        for (method, path), histogram in sorted(histograms.items()):
+            text.histogram(
+                'http_request_duration_seconds',
+                {'service': self._service_name, 'method': method, 'path': path},
+                histogram
+            )
+
+        if self._db_connector is not None:
+            text.metric('db_query_duration_seconds', 'histogram', 'Database connector method latency')
+            for name, histogram in sorted(self._db_connector.query_timings.snapshot().items()):
+                text.histogram('db_query_duration_seconds', {'service': self._service_name, 'query': name}, histogram)
+
+        if len(self._upstreams) != 0:
+            text.metric('upstream_request_duration_seconds', 'histogram', 'Upstream call latency')
+            for upstream_name, upstream in sorted(self._upstreams.items()):
+                for method, histogram in sorted(upstream.timings.snapshot().items()):
+                    text.histogram(
+                        'upstream_request_duration_seconds',
+                        {'service': self._service_name, 'upstream': upstream_name, 'method': method},
+                        histogram
+                    )
+
+            upstream_stats = {name: upstream.stats() for name, upstream in sorted(self._upstreams.items())}
+
+            for metric, metric_type, key, description in (
+                ('upstream_requests_in_flight', 'gauge', 'inFlight', 'Upstream calls in flight'),
+                ('upstream_errors_total', 'counter', 'errors', 'Failed upstream calls'),
+                ('upstream_opened_connections', 'gauge', 'openedConnections', 'Connections opened by the upstream pool')
+            ):
+                text.metric(metric, metric_type, description)
+                for name, stats in upstream_stats.items():
+                    text.sample(metric, {'service': self._service_name, 'upstream': name}, stats[key])
+
+        if self._event_emitter is not None:
+            event_stats = self._event_emitter.stats()
+
+            for metric, metric_type, key, description in (
+                ('event_queue_depth', 'gauge', 'queueDepth', 'Events waiting in the emitter buffer'),
+                ('events_emitted_total', 'counter', 'emitted', 'Events accepted by the emitter'),
+                ('events_sent_total', 'counter', 'sent', 'Events handed to the Kafka producer'),
+                ('events_dropped_total', 'counter', 'dropped', 'Events dropped on buffer overflow'),
+                ('events_errors_total', 'counter', 'errors', 'Events failed to send')
+            ):
+                text.metric(metric, metric_type, description)
+                text.sample(metric, {'service': self._service_name}, event_stats[key])
+
+        if self._kafka_producer is not None:
+            text.metric('kafka_producer_metric', 'gauge', 'Kafka producer client metrics')
+            for name, value in sorted(self._kafka_producer.metrics().get('producer-metrics', {}).items()):
+                if isinstance(value, (int, float)):
+                    text.sample('kafka_producer_metric', {'service': self._service_name, 'name': name}, value)
+
+        self._render_service_metrics(text)
+
+        if len(self._caches) != 0:
+            cache_stats = {name: cache.stats() for name, cache in sorted(self._caches.items())}
+
+            for metric, metric_type, key, description in (
+                ('cache_hits_total', 'counter', 'hits', 'Cache hits'),
+                ('cache_misses_total', 'counter', 'misses', 'Cache misses'),
+                ('cache_evictions_total', 'counter', 'evictions', 'Cache evictions'),
+                ('cache_size', 'gauge', 'size', 'Cached entries')
+            ):
+                text.metric(metric, metric_type, description)
+                for name, stats in cache_stats.items():
+                    text.sample(metric, {'service': self._service_name, 'cache': name}, stats[key])
+
+            text.metric('cache_hit_ratio', 'gauge', 'Cache hits over lookups')
+            for name, stats in cache_stats.items():
+                lookups = stats['hits'] + stats['misses']
+
+                text.sample(
+                    'cache_hit_ratio',
+                    {'service': self._service_name, 'cache': name},
+                    stats['hits'] / lookups if lookups != 0 else 0
+                )
+
+        return text.render()
+
+    def _render_service_metrics(self, text):
+        pass
+
+    def _register_manage_metrics(self):
+        path = '/manage/metrics'
+        methods = ['GET']
+
+        self._logger.info(f'Register route for \'{path}\' with methods: {methods}')
+
+        self._flask_app.add_url_rule(
+            path,
+            view_func=self._manage_metrics,
+            methods=methods
+        )
+
+    def _manage_cache(self):
+        if request.method == 'GET':
+            return make_response({name: cache.stats() for name, cache in self._caches.items()}, 200)
+
+        self._check_manage_cache_access(request)
+
+        name = UserValue.get_from(request.args, 'name').value
+
+        if name not in self._caches:
+            raise UserError('non existent cache', 404)
+
+        key = request.args.get('key')
+        count = self._caches[name].invalidate(key)
+
+        self._logger.info(f'Invalidate {count} entries of cache \'{name}\'')
+
+        return make_response({'invalidated': count}, 200)
+
+    def _check_manage_cache_access(self, request):
+        # manage ports are published on the host, so invalidation needs the shared manage token
+        if not self._manage_token:
+            raise UserError('cache invalidation is disabled, manage token is not set', 403)
+
+        token = request.headers.get(self.manage_token_header, '')
+
+        if not hmac.compare_digest(token.encode(), self._manage_token.encode()):
+            raise UserError('invalid manage token', 403)
+
+    def _register_manage_cache(self):
+        path = '/manage/cache'
+        methods = ['GET', 'DELETE']
+
+        self._logger.info(f'Register route for \'{path}\' with methods: {methods}')
+
+        def view_func():
+            try:
+                return self._manage_cache()
+
+            except UserError as error:
+                return make_response(error.message, error.code)
+
+            except ServerError as error:
+                self._logger.error(f'Server internal error: {error.message["message"]} with code {error.code}')
+
+                return make_response({'message': 'internal error'}, error.code)
+
+            except Exception as error:
+                self._logger.error(f'Unknown internal error: {error}')
+
+                return make_response({'message': 'internal error'}, 500)
+
+        self._flask_app.add_url_rule(
+            path,
+            endpoint='_manage_cache',
+            view_func=view_func,
+            methods=methods
+        )
+
+    def _register_cache(self, name, cache):
+        self._caches[name] = cache
+
+    def _manage_upstreams(self):
+        return make_response({name: upstream.stats() for name, upstream in self._upstreams.items()}, 200)
+
+    def _register_manage_upstreams(self):
+        path = '/manage/upstreams'
+        methods = ['GET']
+
+        self._logger.info(f'Register route for \'{path}\' with methods: {methods}')
+
+        self._flask_app.add_url_rule(
+            path,
+            view_func=self._manage_upstreams,
+            methods=methods
+        )
+
+    def _register_upstream(self, name, upstream):
+        self._upstreams[name] = upstream
+
     def _register_routes(self):
         pass
 
@@ -114,45 +669,117 @@ class ServiceBase:
             methods=handler.methods
         )
 
+    def _create_event_emitter(self):
+        if self._kafka_producer is None:
+            return None
+
+        return EventEmitter(
+            self._service_name,
+            self._kafka_producer,
+            self.event_buffer_size,
+            self.event_batch_size,
+            self.event_linger_s
+        )
+
+    def _send_request_event(self, method, path, latency_s, status):
+        if self._event_emitter is None:
+            return
+
+        encoded = self._event_encoder.encode(
+            method,
+            path,
+            int(time.time() * 1000),
+            latency_s * 1_000_000,
+            status
+        )
+
+        if encoded is None:
+            return
+
+        key, payloads = encoded
+
+        self._logger.debug(f'Send {method} {path} event to {self._service_name} topic')
+
+        for payload in payloads:
+            self._event_emitter.emit(self._service_name, key, payload)
+
+    def _start_metrics_reporter(self):
+        if self._event_emitter is None:
+            return
+
+        self._metrics_reporter_stop = threading.Event()
+        self._metrics_reporter = threading.Thread(target=self._metrics_reporter_job, daemon=True)
+        self._metrics_reporter.start()
+
+    def _stop_metrics_reporter(self):
+        if self._metrics_reporter is None:
+            return
+
+        self._metrics_reporter_stop.set()
+        self._metrics_reporter.join()
+        self._metrics_reporter = None
+
+    def _metrics_reporter_job(self):
+        is_running = True
+
+        while is_running:
+            is_running = not self._metrics_reporter_stop.wait(self.metrics_report_interval_s)
+
+            try:
+                for report in self._request_metrics.take_pending():
+                    report['service'] = self._service_name
+
+                    self._event_emitter.emit(
+                        METRICS_TOPIC,
+                        f'{self._service_name} {report["method"]} {report["path"]}'.encode('utf-8'),
+                        json.dumps(report).encode('utf-8')
+                    )
+
+            except Exception as error:
+                self._logger.error(f'Failed to report request metrics: {error}')
+
     @staticmethod
     def get_current_datetime():
         return datetime.today().strftime('%Y-%m-%d %H:%M:%S')
 
     @staticmethod
     def route(path, methods):
+        assert path in routes.ROUTES, f'route {path} is missing in routes.ROUTES'
+
         def decorate(func):
             def wrapper(self, *args, **kwargs):
                 self._logger.debug(f'Call handler for path: {path}')
 
+                start_time = time.perf_counter()
+                error_class = ''
+
                 try:
-                    method = request.method
-                    
-                    if self._kafka_producer is not None:
-                        payload = f'{method} {path}'.encode('utf-8')
-                        
-                        self._logger.debug(f'Send {payload} to {self._service_name} topic')
-                        
-                        self._kafka_producer.send(
-                            self._service_name,
-                            value=payload,
-                            partition=0
-                        )
-                        # self._kafka_producer.flush()
-                    
-                    return func(self=self, *args, **kwargs)
+                    response = func(self=self, *args, **kwargs)
 
                 except UserError as error:
-                    return make_response(error.message, error.code)
+                    error_class = type(error).__name__
+
+                    response = make_response(error.message, error.code)
 
                 except ServerError as error:
                     self._logger.error(f'Server internal error: {error.message["message"]} with code {error.code}')
+                    error_class = type(error).__name__
 
-                    return make_response({'message': 'internal error'}, error.code)
+                    response = make_response({'message': 'internal error'}, error.code)
 
                 except Exception as error:
                     self._logger.error(f'Unknown internal error: {error}')
+                    error_class = type(error).__name__
                     
-                    return make_response({'message': 'internal error'}, 500)
+                    response = make_response({'message': 'internal error'}, 500)
+
+                latency_s = time.perf_counter() - start_time
+                status = getattr(response, 'status_code', 200)
+
+                self._request_metrics.record(request.method, path, latency_s, status, error_class)
+                self._send_request_event(request.method, path, latency_s, status)
+
+                return response
 
             setattr(wrapper, 'path', path)
             setattr(wrapper, 'methods', methods)
@@ -175,6 +802,12 @@ class ServiceBase:
 
 class ServerBaseWithKeycloak(ServiceBase):
     realm_name='master'
+
+    jwks_refresh_interval_s = 3600
+    jwks_min_refresh_interval_s = 10
+
+    token_cache_size = 4096
+    token_cache_ttl_s = 3600
     
     def __init__(
         self,
@@ -193,6 +826,13 @@ class ServerBaseWithKeycloak(ServiceBase):
             realm_name=self.realm_name
         )
 
+        self._jwks = None
+        self._jwks_fetch_time = 0
+        self._jwks_lock = threading.Lock()
+
+        self._token_cache = TtlLruCache(self.token_cache_size, self.token_cache_ttl_s)
+        self._register_cache('tokens', self._token_cache)
+
     def _get_user_token_by(self, username, password):
         return ServerValue.get_from(self._keycloak_openid.token(username=username, password=password), 'access_token').value
 
@@ -209,8 +849,10 @@ class ServerBaseWithKeycloak(ServiceBase):
         return token
 
     def _get_username_by(self, token):
+        claims = self._validate_token(token)
+
         try:
-            return ServerValue.get_from(self._keycloak_openid.userinfo(token), 'preferred_username').value
+            return ServerValue.get_from(claims, 'preferred_username').value
 
         except Exception as error:
             self._logger.error(f'Failed get username with error: {error}')
@@ -223,11 +865,56 @@ class ServerBaseWithKeycloak(ServiceBase):
             
             raise UserError(message, 401)
 
+        token_hash = hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+        claims = self._token_cache.get(token_hash)
+
+        if claims is not None:
+            return claims
+
         try:
-            self._keycloak_openid.decode_token(token)
+            claims = self._keycloak_openid.decode_token(token, key=self._get_signing_key(token))
+
+            if 'exp' in claims:
+                self._token_cache.put(token_hash, claims, claims['exp'] - time.time())
+
+            return claims
 
         except jwt.JWTExpired as error:
             raise_invalid_token(error, 'token experid')
 
+        except UserError:
+            raise
+
         except Exception as error:
             raise_invalid_token(error)
+
+    def _get_signing_key(self, token):
+        kid = self._get_token_header(token).get('kid')
+
+        with self._jwks_lock:
+            now = time.monotonic()
+            since_fetch = now - self._jwks_fetch_time
+
+            if (
+                self._jwks is None
+                or since_fetch > self.jwks_refresh_interval_s
+                or (self._jwks.get_key(kid) is None and since_fetch > self.jwks_min_refresh_interval_s)
+            ):
+                self._logger.info('Fetch signing keys from keycloak JWKS')
+
+                self._jwks = jwk.JWKSet.from_json(json.dumps(self._keycloak_openid.certs()))
+                self._jwks_fetch_time = now
+
+            key = self._jwks.get_key(kid)
+
+        if key is None:
+            raise UserError('invalid token', 401)
+
+        return key
+
+    @staticmethod
+    def _get_token_header(token):
+        header = token.split('.')[0]
+
+        return json.loads(base64.urlsafe_b64decode(header + '=' * (-len(header) % 4)))
@@ -16,21 +16,70 @@ from getters import UserValue
 
 from kafka import KafkaProducer
 
+SELECT_OR_INSERT_PRIVILEGE = (
+    'WITH inserted AS ( '
+    '    INSERT INTO privilege(username, status, balance) VALUES($1, \'BRONZE\', 0) '
+    '    ON CONFLICT (username) DO NOTHING '
+    '    RETURNING id, status, balance '
+    '), user_privilege AS ( '
+    '    SELECT id, status, balance FROM inserted '
+    '    UNION ALL '
+    '    SELECT id, status, balance FROM privilege WHERE username = $1 '
+    ') '
+)
+
+SELECT_PRIVILEGE_HISTORY = (
+    'SELECT id, privilege_id, ticket_uid, datetime, balance_diff, operation_type FROM privilege_history '
+)
+
+
 class BonusDbConnector(DbConnectorBase):
-    def __init__(self, host, port, database, user, password, sslmode='disable'):
-        super().__init__('BounsDbConnector', host, port, database, user, password, sslmode)
+    migrations = 'privileges'
+
+    statements = {
+        'get_user_privilege': 'SELECT id, username, status, balance FROM privilege WHERE username = $1',
+        'get_or_add_user_privilege': f'{SELECT_OR_INSERT_PRIVILEGE} SELECT id, status, balance FROM user_privilege',
+        'get_or_add_user_privilege_with_history': (
+            f'{SELECT_OR_INSERT_PRIVILEGE} '
+            f'SELECT '
+            f'    user_privilege.status, '
+            f'    user_privilege.balance, '
+            f'    (SELECT COUNT(*) FROM privilege_history WHERE privilege_id = user_privilege.id), '
+            f'    history.datetime, '
+            f'    history.ticket_uid, '
+            f'    history.balance_diff, '
+            f'    history.operation_type '
+            f'FROM user_privilege LEFT JOIN LATERAL ( '
+            f'    SELECT id, datetime, ticket_uid, balance_diff, operation_type FROM privilege_history '
+            f'    WHERE privilege_id = user_privilege.id '
+            f'    ORDER BY id LIMIT $2 OFFSET $3 '
+            f') history ON true '
+            f'ORDER BY history.id'
+        ),
+        'update_user_balance': (
+            'WITH updated AS ( '
+            '    UPDATE privilege SET balance = balance + $2 WHERE username = $1 '
+            '    RETURNING id, status, balance '
+            '), history AS ( '
+            '    INSERT INTO privilege_history(privilege_id, ticket_uid, datetime, balance_diff, operation_type) '
+            '    SELECT id, $3::uuid, $4::timestamp, $5::int, $6::varchar FROM updated '
+            ') '
+            'SELECT status, balance FROM updated'
+        ),
+        'get_privilege_history': f'{SELECT_PRIVILEGE_HISTORY} WHERE privilege_id = $1',
+        'get_privilege_history_by_ticket': f'{SELECT_PRIVILEGE_HISTORY} WHERE ticket_uid = $1'
+    }
 
-    def get_user_privilege(self, user):
-        query = tools.simplify_sql_query(
-            f'SELECT id, username, status, balance FROM privilege WHERE username = \'{user}\''
-        )
+    def __init__(self, host, port, database, user, password, sslmode='disable', pool_min=1, pool_max=10):
+        super().__init__('BounsDbConnector', host, port, database, user, password, sslmode, pool_min, pool_max)
 
-        self._logger.debug(f'Execute query: {query}')
-        cursor = self._connection.cursor()
-        cursor.execute(query)
+    def get_user_privilege(self, user):
+        with self._connection() as connection:
+            cursor = connection.cursor()
+            self._execute(cursor, 'get_user_privilege', (user,))
 
-        row = cursor.fetchone()
-        cursor.close()
+            row = cursor.fetchone()
+            cursor.close()
 
         if row is None:
             return None
@@ -41,92 +90,94 @@ class BonusDbConnector(DbConnectorBase):
             'status': row[2],
             'balance': row[3]
         }
-    
-    def add_user_privilege(self, user):
-        query = tools.simplify_sql_query(
-            f'INSERT INTO privilege(username, status, balance) VALUES(\'{user}\', \'BRONZE\', 0)'
-        )
 
-        self._logger.debug(f'Execute query: {query}')
-        cursor = self._connection.cursor()
-        cursor.execute(query)
+    def get_or_add_user_privilege(self, user):
+        row = self._fetch_privilege_rows('get_or_add_user_privilege', (user,))[0]
 
-        cursor.close()
-        self._connection.commit()
+        return {
+            'id': row[0],
+            'username': user,
+            'status': row[1],
+            'balance': row[2]
+        }
 
-    def update_user_balance(self, user, ticket_uid, datetime, balance_diff, operation_type):
-        user_privilege = self.get_user_privilege(user)
+    def get_or_add_user_privilege_with_history(self, user, history_page, history_size):
+        table = self._fetch_privilege_rows(
+            'get_or_add_user_privilege_with_history',
+            (user, history_size, (history_page - 1) * history_size)
+        )
+
+        return {
+            'status': table[0][0],
+            'balance': table[0][1],
+            'history_total': table[0][2],
+            'history': [
+                {
+                    'datetime': row[3],
+                    'ticket_uid': row[4],
+                    'balance_diff': row[5],
+                    'operation_type': row[6]
+                }
+                for row in table
+                if row[3] is not None
+            ]
+        }
 
-        assert user_privilege is not None
-        privilege_id = user_privilege['id']
+    def _fetch_privilege_rows(self, statement_name, parameters):
+        # a privilege inserted by a concurrent transaction is invisible to both parts of the statement, retry once
+        for _ in range(2):
+            with self._connection() as connection:
+                cursor = connection.cursor()
+                self._execute(cursor, statement_name, parameters)
 
-        if operation_type == 'DEBIT_THE_ACCOUNT':
-            new_balance = user_privilege['balance'] - balance_diff
-        else:
-            new_balance = user_privilege['balance'] + balance_diff
+                table = cursor.fetchall()
+                cursor.close()
+                connection.commit()
 
-        query = tools.simplify_sql_query(
-            f'START TRANSACTION;\n'
+            if len(table) != 0:
+                return table
 
-            f'UPDATE privilege SET balance = {new_balance} WHERE username = \'{user}\';\n'
+        raise errors.ServerError('failed to get user privilege')
 
-            f'INSERT INTO privilege_history(privilege_id, ticket_uid, datetime, balance_diff, operation_type) '
-            f'VALUES({privilege_id}, \'{ticket_uid}\', \'{datetime}\', {balance_diff}, \'{operation_type}\');\n'
+    def update_user_balance(self, user, ticket_uid, datetime, balance_diff, operation_type):
+        if operation_type == 'DEBIT_THE_ACCOUNT':
+            signed_balance_diff = -balance_diff
+        else:
+            signed_balance_diff = balance_diff
+
+        with self._connection() as connection:
+            cursor = connection.cursor()
+            self._execute(
+                cursor,
+                'update_user_balance',
+                (user, signed_balance_diff, ticket_uid, datetime, balance_diff, operation_type)
+            )
 
-            f'COMMIT TRANSACTION;'
-        )
+            row = cursor.fetchone()
+            cursor.close()
+            connection.commit()
 
-        self._logger.debug(f'Execute query: {query}')
-        cursor = self._connection.cursor()
-        cursor.execute(query)
+        assert row is not None
 
-        cursor.close()
-        self._connection.commit()
+        return {
+            'status': row[0],
+            'balance': row[1]
+        }
     
     def get_privilege_history(self, privilege_id):
-        query = tools.simplify_sql_query(
-            f'SELECT id, privilege_id, ticket_uid, datetime, balance_diff, operation_type FROM privilege_history '
-            f'WHERE privilege_id = {privilege_id}'
-        )
-
-        self._logger.debug(f'Execute query: {query}')
-        cursor = self._connection.cursor()
-        cursor.execute(query)
-
-        table = cursor.fetchall()
-        cursor.close()
-
-        if table is None:
-            return None
-        
-        return [
-            {
-                'id': row[0],
-                'privilege_id': row[1],
-                'ticket_uid': row[2],
-                'datetime': row[3],
-                'balance_diff': row[4],
-                'operation_type': row[5]
-            }
-            for row in table
-        ]
+        return self._select_privilege_history('get_privilege_history', (privilege_id,))
     
     def get_privilege_history_by_ticket(self, ticket_uid):
-        query = tools.simplify_sql_query(
-            f'SELECT id, privilege_id, ticket_uid, datetime, balance_diff, operation_type FROM privilege_history '
-            f'WHERE ticket_uid = \'{ticket_uid}\''
-        )
+        return self._select_privilege_history('get_privilege_history_by_ticket', (ticket_uid,))
 
-        self._logger.debug(f'Execute query: {query}')
-        cursor = self._connection.cursor()
-        cursor.execute(query)
+    def _select_privilege_history(self, statement_name, parameters):
+        with self._connection() as connection:
+            cursor = connection.cursor()
+            self._execute(cursor, statement_name, parameters)
 
-        table = cursor.fetchall()
-        cursor.close()
+            table = cursor.fetchall()
+            cursor.close()
 
-        if table is None:
-            return None
-        
         return [
             {
                 'id': row[0],
@@ -140,6 +191,8 @@ class BonusDbConnector(DbConnectorBase):
         ]
 
 class BonusService(ServerBaseWithKeycloak):
+    history_page_size = 100
+
     def __init__(
             self, 
             host, 
@@ -149,7 +202,8 @@ class BonusService(ServerBaseWithKeycloak):
             keycloak_port,
             keycloak_client_id,
             keycloak_client_secret,
-            kafka_producer
+            kafka_producer,
+            manage_token=None
         ):
         super().__init__(
             f'http://{keycloak_host}:{keycloak_port}',
@@ -159,7 +213,8 @@ class BonusService(ServerBaseWithKeycloak):
             host, 
             port, 
             db_connector,
-            kafka_producer
+            kafka_producer,
+            manage_token
         )
 
     # API requests handlers
@@ -172,13 +227,18 @@ class BonusService(ServerBaseWithKeycloak):
         if method == 'GET':
             username = self._get_username_by(self._get_user_token_from(request))
 
-            user_privilege = self._db_connector.get_user_privilege(username)
+            with UserValue.ErrorChain() as error_chain:
+                if 'historyPage' in request.args:
+                    history_page = UserValue.get_from(request.args, 'historyPage', error_chain).cast_to_int().rule(rules.grater_zero).value
+                else:
+                    history_page = 1
 
-            if user_privilege is None:
-                self._db_connector.add_user_privilege(username)
-                user_privilege = self._db_connector.get_user_privilege(username)
-            
-            user_privilege_history = self._db_connector.get_privilege_history(user_privilege['id'])
+                if 'historySize' in request.args:
+                    history_size = UserValue.get_from(request.args, 'historySize', error_chain).cast_to_int().rule(rules.greate_equal_zero).value
+                else:
+                    history_size = self.history_page_size
+
+            user_privilege = self._db_connector.get_or_add_user_privilege_with_history(username, history_page, history_size)
 
             return make_response(
                 {
@@ -191,8 +251,11 @@ class BonusService(ServerBaseWithKeycloak):
                             'balanceDiff': i['balance_diff'],
                             'operationType': i['operation_type']
                         }
-                        for i in user_privilege_history
-                    ]
+                        for i in user_privilege['history']
+                    ],
+                    'historyPage': history_page,
+                    'historyPageSize': history_size,
+                    'historyTotalElements': user_privilege['history_total']
                 },
                 200
             )            
@@ -206,11 +269,7 @@ class BonusService(ServerBaseWithKeycloak):
         if method == 'POST':
             username = self._get_username_by(self._get_user_token_from(request))
 
-            user_privilege = self._db_connector.get_user_privilege(username)
-
-            if user_privilege is None:
-                self._db_connector.add_user_privilege(username)
-                user_privilege = self._db_connector.get_user_privilege(username)
+            self._db_connector.get_or_add_user_privilege(username)
 
             UserValue.get_from(request.headers, 'Content-Type').rule(rules.json_content)
             body = request.json
@@ -225,8 +284,7 @@ class BonusService(ServerBaseWithKeycloak):
             else:
                 operation_type = 'DEBIT_THE_ACCOUNT'
 
-            self._db_connector.update_user_balance(username, ticket_uid, datetime, balance_diff, operation_type)
-            user_privilege = self._db_connector.get_user_privilege(username)
+            user_privilege = self._db_connector.update_user_balance(username, ticket_uid, datetime, balance_diff, operation_type)
 
             return make_response(
                 {
@@ -284,13 +342,23 @@ if __name__ == '__main__':
     parser.add_argument('--db-user', type=str, required=True)
     parser.add_argument('--db-password', type=str, required=True)
     parser.add_argument('--db-sslmode', type=str, default='disable')
+    parser.add_argument('--db-pool-min', type=int, default=1)
+    parser.add_argument('--db-pool-max', type=int, default=10)
     parser.add_argument('--oidc-host', type=str, default='localhost')
     parser.add_argument('--oidc-port', type=int, default=8030)
     parser.add_argument('--oidc-client-id', type=str, default='ticket-service')
     parser.add_argument('--oidc-client-secret', type=str, required=True)
     parser.add_argument('--kafka-host', type=str, default='localhost')
     parser.add_argument('--kafka-port', type=str, default=29092)
+    parser.add_argument('--kafka-linger-ms', type=int, default=50)
+    parser.add_argument('--kafka-compression', type=str, default='gzip')
+    parser.add_argument('--manage-token', type=str, default=None)
     parser.add_argument('--debug', action='store_true')
+    parser.add_argument('--server', type=str, choices=['flask', 'gunicorn'], default='flask')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--backlog', type=int, default=2048)
+    parser.add_argument('--graceful-timeout', type=int, default=30)
 
     cmd_args = parser.parse_args()
 
@@ -308,13 +376,27 @@ if __name__ == '__main__':
             cmd_args.db,
             cmd_args.db_user,
             cmd_args.db_password,
-            cmd_args.db_sslmode
+            cmd_args.db_sslmode,
+            cmd_args.db_pool_min,
+            cmd_args.db_pool_max
         ),
         cmd_args.oidc_host,
         cmd_args.oidc_port,
         cmd_args.oidc_client_id,
         cmd_args.oidc_client_secret,
-        KafkaProducer(bootstrap_servers=f'{cmd_args.kafka_host}:{cmd_args.kafka_port}'),
+        KafkaProducer(
+            bootstrap_servers=f'{cmd_args.kafka_host}:{cmd_args.kafka_port}',
+            linger_ms=cmd_args.kafka_linger_ms,
+            compression_type=cmd_args.kafka_compression
+        ),
+        manage_token=cmd_args.manage_token
     )
 
-    service.run(cmd_args.debug)
+    service.run(
+        cmd_args.debug,
+        cmd_args.server,
+        cmd_args.workers,
+        cmd_args.threads,
+        cmd_args.backlog,
+        cmd_args.graceful_timeout
+    )
@@ -0,0 +1,76 @@
+from collections import OrderedDict
+
+import threading
+import time
+
+
+class TtlLruCache:
+    def __init__(self, max_size, ttl_s):
+        assert max_size > 0 and ttl_s > 0
+
+        self._max_size = max_size
+        self._ttl_s = ttl_s
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            value, expire_time = entry
+
+            if expire_time <= time.monotonic():
+                del self._entries[key]
+
+                self.misses += 1
+                self.evictions += 1
+                return None
+
+            self._entries.move_to_end(key)
+
+            self.hits += 1
+            return value
+
+    def put(self, key, value, ttl_s=None):
+        ttl_s = self._ttl_s if ttl_s is None else min(ttl_s, self._ttl_s)
+
+        if ttl_s <= 0:
+            return
+
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl_s)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key=None):
+        with self._lock:
+            if key is None:
+                count = len(self._entries)
+                self._entries.clear()
+
+                return count
+
+            return 0 if self._entries.pop(key, None) is None else 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'maxSize': self._max_size,
+                'ttl': self._ttl_s,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
@@ -0,0 +1,90 @@
+from collections import deque
+
+import logging
+import threading
+
+
+class EventEmitter:
+    def __init__(self, name, producer, buffer_size=10000, batch_size=500, linger_s=0.05):
+        self._logger = logging.getLogger(f'{name} events')
+
+        self._producer = producer
+        self._batch_size = batch_size
+        self._linger_s = linger_s
+
+        self._buffer = deque(maxlen=buffer_size)
+        self._condition = threading.Condition()
+        self._is_running = True
+
+        self.emitted = 0
+        self.sent = 0
+        self.dropped = 0
+        self.errors = 0
+
+        self._flusher = threading.Thread(target=self._flusher_job, daemon=True)
+        self._flusher.start()
+
+    def emit(self, topic, key, value):
+        with self._condition:
+            if len(self._buffer) == self._buffer.maxlen:
+                self.dropped += 1
+
+            self._buffer.append((topic, key, value))
+            self.emitted += 1
+
+            if len(self._buffer) >= self._batch_size:
+                self._condition.notify()
+
+    def close(self, timeout_s=5):
+        with self._condition:
+            self._is_running = False
+            self._condition.notify()
+
+        self._flusher.join(timeout_s)
+
+    def stats(self):
+        with self._condition:
+            return {
+                'queueDepth': len(self._buffer),
+                'bufferSize': self._buffer.maxlen,
+                'emitted': self.emitted,
+                'sent': self.sent,
+                'dropped': self.dropped,
+                'errors': self.errors
+            }
+
+    def _take_batch(self):
+        with self._condition:
+            if self._is_running and len(self._buffer) < self._batch_size:
+                self._condition.wait(self._linger_s)
+
+            batch = []
+            while len(self._buffer) != 0 and len(batch) < self._batch_size:
+                batch.append(self._buffer.popleft())
+
+            return batch, self._is_running or len(self._buffer) != 0
+
+    def _flusher_job(self):
+        is_running = True
+
+        while is_running:
+            batch, is_running = self._take_batch()
+
+            sent = 0
+            for topic, key, value in batch:
+                try:
+                    self._producer.send(topic, key=key, value=value)
+                    sent += 1
+
+                except Exception as error:
+                    self._logger.error(f'Failed to send event to {topic} topic, error: {error}')
+
+            with self._condition:
+                self.sent += sent
+                self.errors += len(batch) - sent
+
+        try:
+            self._producer.flush()
+
+        except Exception as error:
+            self._logger.error(f'Failed to flush events, error: {error}')
@@ -3,6 +3,8 @@ import logging
 from base import ServiceBase
 from base import DbConnectorBase
 
+from cache import TtlLruCache
+
 import tools
 import errors
 import rules
@@ -13,36 +15,73 @@ from flask import make_response
 
 import argparse
 
+import base64
+
 from kafka import KafkaProducer
 
+SELECT_FLIGHTS = (
+    'SELECT '
+    '    flight.id, '
+    '    number, '
+    '    datetime, '
+    '    price, '
+    '    capacity, '
+    '    CONCAT(from_airport.city, \' \' , from_airport.name) as from_airport, '
+    '    CONCAT(to_airport.city, \' \', to_airport.name) as to_airport '
+    'FROM flight '
+    'JOIN airport as from_airport ON flight.from_airport_id = from_airport.id '
+    'JOIN airport as to_airport ON flight.to_airport_id = to_airport.id '
+)
+
+
 class FlightDbConnector(DbConnectorBase):
-    def __init__(self, host, port, database, user, password, sslmode='disable'):
-        super().__init__('FlightDbConnector', host, port, database, user, password, sslmode)
+    migrations = 'flights'
+
+    statements = {
+        'get_flights': f'{SELECT_FLIGHTS} ORDER BY flight.id LIMIT $1 OFFSET $2',
+        'get_flights_after': f'{SELECT_FLIGHTS} WHERE flight.id > $1 ORDER BY flight.id LIMIT $2',
+        'get_flights_count': 'SELECT COUNT(1) FROM flight',
+        'get_flight_by_number': f'{SELECT_FLIGHTS} WHERE number = $1',
+        'get_flights_by_numbers': f'{SELECT_FLIGHTS} WHERE number = ANY($1)'
+    }
+
+    def __init__(self, host, port, database, user, password, sslmode='disable', pool_min=1, pool_max=10):
+        super().__init__('FlightDbConnector', host, port, database, user, password, sslmode, pool_min, pool_max)
 
     def get_flights(self, page_number, page_size):
-        query = tools.simplify_sql_query(
-            f'SELECT id, number, datetime, price, from_airport, to_airport FROM('
-            f'    SELECT '
-            f'        flight.id, '
-            f'        number, '
-            f'        datetime, '
-            f'        price, '
-            f'        CONCAT(from_airport.city, \' \' , from_airport.name) as from_airport, '
-            f'        CONCAT(to_airport.city, \' \', to_airport.name) as to_airport, '
-            f'        ROW_NUMBER() OVER (ORDER BY flight.id) as row '
-            f'    FROM flight '
-            f'    JOIN airport as from_airport ON flight.from_airport_id = from_airport.id '
-            f'    JOIN airport as to_airport ON flight.to_airport_id = to_airport.id'
-            f') as flight_with_row '
-            f'WHERE {(page_number - 1) * page_size + 1} <= row AND row < {page_number * page_size + 1}'
-        )
-
-        self._logger.debug(f'Execute query: {query}')
-        cursor = self._connection.cursor()
-        cursor.execute(query)
-
-        table = cursor.fetchall()
-        cursor.close()
+        return self._select_flights('get_flights', (page_size, (page_number - 1) * page_size))
+
+    def get_flights_after(self, last_id, page_size):
+        return self._select_flights('get_flights_after', (last_id, page_size))
+
+    def get_flights_count(self):
+        with self._connection() as connection:
+            cursor = connection.cursor()
+            self._execute(cursor, 'get_flights_count')
+
+            row = cursor.fetchone()
+            cursor.close()
+
+        return row[0]
+
+    def get_flight_by_number(self, number):
+        flights = self._select_flights('get_flight_by_number', (number,))
+
+        if len(flights) == 0:
+            return None
+
+        return flights[0]
+
+    def get_flights_by_numbers(self, numbers):
+        return self._select_flights('get_flights_by_numbers', (list(numbers),))
+
+    def _select_flights(self, statement_name, parameters):
+        with self._connection() as connection:
+            cursor = connection.cursor()
+            self._execute(cursor, statement_name, parameters)
+
+            table = cursor.fetchall()
+            cursor.close()
 
         return [
             {
@@ -50,52 +89,33 @@ class FlightDbConnector(DbConnectorBase):
                 'number': row[1],
                 'datetime': row[2],
                 'price': row[3],
-                'from_airport': row[4],
-                'to_airport': row[5]
+                'capacity': row[4],
+                'from_airport': row[5],
+                'to_airport': row[6]
             }
             for row in table
         ]
 
-    def get_flight_by_number(self, number):
-        query = tools.simplify_sql_query(
-            f'SELECT id, number, datetime, price, from_airport, to_airport FROM('
-            f'    SELECT '
-            f'        flight.id, '
-            f'        number, '
-            f'        datetime, '
-            f'        price, '
-            f'        CONCAT(from_airport.city, \' \' , from_airport.name) as from_airport, '
-            f'        CONCAT(to_airport.city, \' \', to_airport.name) as to_airport '
-            f'    FROM flight '
-            f'    JOIN airport as from_airport ON flight.from_airport_id = from_airport.id '
-            f'    JOIN airport as to_airport ON flight.to_airport_id = to_airport.id'
-            f') as flight_with_airport '
-            f'WHERE number = \'{number}\''
-        )
-
-        self._logger.debug(f'Execute query: {query}')
-        cursor = self._connection.cursor()
-        cursor.execute(query)
-
-        row = cursor.fetchone()
-        cursor.close()
-
-        if row is None:
-            return None
-
-        return {
-            'id': row[0],
-            'number': row[1],
-            'datetime': row[2],
-            'price': row[3],
-            'from_airport': row[4],
-            'to_airport': row[5]
-        }
-
 
 class FlightService(ServiceBase):
-    def __init__(self, host, port, db_connector, kafka_producer):
-        super().__init__('FlightService', host, port, db_connector, kafka_producer)
+    def __init__(
+        self,
+        host,
+        port,
+        db_connector,
+        kafka_producer,
+        flight_cache_size=1024,
+        flight_cache_ttl_s=300,
+        flights_count_ttl_s=60,
+        manage_token=None
+    ):
+        super().__init__('FlightService', host, port, db_connector, kafka_producer, manage_token)
+
+        self._flight_cache = TtlLruCache(flight_cache_size, flight_cache_ttl_s)
+        self._register_cache('flights', self._flight_cache)
+
+        self._flights_count_cache = TtlLruCache(1, flights_count_ttl_s)
+        self._register_cache('flights_count', self._flights_count_cache)
 
     # API requests handlers
     ####################################################################################################################
@@ -105,28 +125,83 @@ class FlightService(ServiceBase):
         method = request.method
 
         if method == 'GET':
-
             with UserValue.ErrorChain() as error_chain:
-                page_number = UserValue.get_from(request.args, 'page', error_chain).cast_to_int().rule(rules.grater_zero).value
                 page_size = UserValue.get_from(request.args, 'size', error_chain).cast_to_int().rule(rules.grater_zero).value
 
-            table = self._db_connector.get_flights(page_number, page_size)
+                if 'cursor' in request.args:
+                    page_number = None
+                    last_id = UserValue.get_from(request.args, 'cursor', error_chain).cast_to(self.decode_cursor).value
+                else:
+                    page_number = UserValue.get_from(request.args, 'page', error_chain).cast_to_int().rule(rules.grater_zero).value
+
+            if page_number is None:
+                table = self._db_connector.get_flights_after(last_id, page_size + 1)
+            else:
+                table = self._db_connector.get_flights(page_number, page_size + 1)
+
+            next_cursor = None
+            if len(table) > page_size:
+                table = table[:page_size]
+                next_cursor = self.encode_cursor(table[-1]['id'])
+
+            message = {
+                'pageSize': page_size,
+                'totalElements': self._get_flights_count(),
+                'nextCursor': next_cursor,
+                'items': [
+                    {
+                        'flightNumber': row['number'],
+                        'fromAirport': row['from_airport'],
+                        'toAirport': row['to_airport'],
+                        'date': row['datetime'],
+                        'price': row['price'],
+                        'capacity': row['capacity']
+                    }
+                    for row in table
+                ]
+            }
+
+            if page_number is not None:
+                message['page'] = page_number
+
+            return make_response(message, 200)
+
+        assert False, 'Invalid request method'
+
+    @ServiceBase.route('/api/v1/flights/batch', ['GET'])
+    def _api_v1_flights_batch(self):
+        method = request.method
+
+        if method == 'GET':
+            numbers = UserValue.get_from(request.args, 'numbers').rule(rules.not_empty).value
+            numbers = [number for number in dict.fromkeys(numbers.split(',')) if number != '']
+
+            table = []
+            missed_numbers = []
+            for number in numbers:
+                flight = self._flight_cache.get(number)
+
+                if flight is None:
+                    missed_numbers.append(number)
+                else:
+                    table.append(flight)
+
+            if len(missed_numbers) != 0:
+                for flight in self._db_connector.get_flights_by_numbers(missed_numbers):
+                    self._flight_cache.put(flight['number'], flight)
+                    table.append(flight)
 
             return make_response(
                 {
-                    'page': page_number,
-                    'pageSize': page_size,
-                    'totalElements': len(table),
-                    'items': [
-                        {
-                            'flightNumber': row['number'],
-                            'fromAirport': row['from_airport'],
-                            'toAirport': row['to_airport'],
-                            'date': row['datetime'],
-                            'price': row['price']
-                        }
-                        for row in table
-                    ]
+                    row['number']: {
+                        'flightNumber': row['number'],
+                        'fromAirport': row['from_airport'],
+                        'toAirport': row['to_airport'],
+                        'date': row['datetime'],
+                        'price': row['price'],
+                        'capacity': row['capacity']
+                    }
+                    for row in table
                 },
                 200
             )
@@ -138,10 +213,15 @@ class FlightService(ServiceBase):
         method = request.method
 
         if method == 'GET':
-            flight = self._db_connector.get_flight_by_number(number)
+            flight = self._flight_cache.get(number)
 
             if flight is None:
-                raise errors.UserError('non existent flight', 404)
+                flight = self._db_connector.get_flight_by_number(number)
+
+                if flight is None:
+                    raise errors.UserError('non existent flight', 404)
+
+                self._flight_cache.put(number, flight)
 
             return make_response(
                 {
@@ -149,7 +229,8 @@ class FlightService(ServiceBase):
                     'fromAirport': flight['from_airport'],
                     'toAirport': flight['to_airport'],
                     'date': flight['datetime'],
-                    'price': flight['price']
+                    'price': flight['price'],
+                    'capacity': flight['capacity']
                 },
                 200
             )
@@ -159,8 +240,29 @@ class FlightService(ServiceBase):
     # Helpers
     ####################################################################################################################
 
+    @staticmethod
+    def encode_cursor(last_id):
+        return base64.urlsafe_b64encode(str(last_id).encode('utf-8')).decode('utf-8')
+
+    @staticmethod
+    def decode_cursor(cursor):
+        if cursor == '':
+            return 0
+
+        return int(base64.urlsafe_b64decode(cursor.encode('utf-8')).decode('utf-8'))
+
+    def _get_flights_count(self):
+        count = self._flights_count_cache.get('count')
+
+        if count is None:
+            count = self._db_connector.get_flights_count()
+            self._flights_count_cache.put('count', count)
+
+        return count
+
     def _register_routes(self):
         self._register_route('_api_v1_flights')
+        self._register_route('_api_v1_flights_batch')
         self._register_route('_api_v1_flights_aNumber')
 
 
@@ -176,9 +278,21 @@ if __name__ == '__main__':
     parser.add_argument('--db-user', type=str, required=True)
     parser.add_argument('--db-password', type=str, required=True)
     parser.add_argument('--db-sslmode', type=str, default='disable')
+    parser.add_argument('--db-pool-min', type=int, default=1)
+    parser.add_argument('--db-pool-max', type=int, default=10)
+    parser.add_argument('--flight-cache-size', type=int, default=1024)
+    parser.add_argument('--flight-cache-ttl', type=int, default=300)
     parser.add_argument('--kafka-host', type=str, default='localhost')
     parser.add_argument('--kafka-port', type=str, default=29092)
+    parser.add_argument('--kafka-linger-ms', type=int, default=50)
+    parser.add_argument('--kafka-compression', type=str, default='gzip')
+    parser.add_argument('--manage-token', type=str, default=None)
     parser.add_argument('--debug', action='store_true')
+    parser.add_argument('--server', type=str, choices=['flask', 'gunicorn'], default='flask')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--backlog', type=int, default=2048)
+    parser.add_argument('--graceful-timeout', type=int, default=30)
 
     cmd_args = parser.parse_args()
 
@@ -196,9 +310,25 @@ if __name__ == '__main__':
             cmd_args.db,
             cmd_args.db_user,
             cmd_args.db_password,
-            cmd_args.db_sslmode
+            cmd_args.db_sslmode,
+            cmd_args.db_pool_min,
+            cmd_args.db_pool_max
         ),
-        KafkaProducer(bootstrap_servers=f'{cmd_args.kafka_host}:{cmd_args.kafka_port}')
+        KafkaProducer(
+            bootstrap_servers=f'{cmd_args.kafka_host}:{cmd_args.kafka_port}',
+            linger_ms=cmd_args.kafka_linger_ms,
+            compression_type=cmd_args.kafka_compression
+        ),
+        cmd_args.flight_cache_size,
+        cmd_args.flight_cache_ttl,
+        manage_token=cmd_args.manage_token
     )
 
-    service.run(cmd_args.debug)
+    service.run(
+        cmd_args.debug,
+        cmd_args.server,
+        cmd_args.workers,
+        cmd_args.threads,
+        cmd_args.backlog,
+        cmd_args.graceful_timeout
+    )
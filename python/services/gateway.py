@@ -3,33 +3,28 @@ import logging
 from base import ServerBaseWithKeycloak
 from getters import UserValue
 from errors import UserError, ServerError
+from cache import TtlLruCache
 import tools
 
-import requests
+from upstream import ServiceInfo, RequestBackup
 
 from flask import request as flask_request
 from flask import make_response
 
 import argparse
 
-from time import time
-
 from keycloak import KeycloakAdmin
 from keycloak import KeycloakPostError, KeycloakAuthenticationError
 
 from kafka import KafkaProducer
 
-class ServiceInfo:
-    def __init__(self, url):
-        self.url = url
-        self.queue = []
-        self.error_level = 0
-        self.last_error_time = 0
-
 ALL_METHODS = ['GET', 'POST', 'DELETE']
 
 
 class Gateway(ServerBaseWithKeycloak):
+    admin_role = 'admin'
+    admins_cache_ttl_s = 60
+
     def __init__(
         self, 
         host, port, 
@@ -45,7 +40,10 @@ class Gateway(ServerBaseWithKeycloak):
         keycloak_admin_username,
         keycloak_admin_password,
         kafka_producer,
-        authorization_required=True # enable authorization check
+        authorization_required=True, # enable authorization check
+        upstream_pool_size=32,
+        upstream_connect_timeout_s=3,
+        upstream_read_timeout_s=30
     ):
         keycloak_url = f'http://{keycloak_host}:{keycloak_port}'
         
@@ -59,10 +57,17 @@ class Gateway(ServerBaseWithKeycloak):
             kafka_producer=kafka_producer
         )
 
-        self._flight_service_info = ServiceInfo(f'http://{flight_service_host}:{flight_service_port}')
-        self._ticket_service_info = ServiceInfo(f'http://{ticket_service_host}:{ticket_service_port}')
-        self._bonus_service_info = ServiceInfo(f'http://{bonus_service_host}:{bonus_service_port}')
-        self._stats_service_info = ServiceInfo(f'http://{stats_service_host}:{stats_service_port}')
+        upstream_args = (upstream_pool_size, upstream_connect_timeout_s, upstream_read_timeout_s)
+
+        self._flight_service_info = ServiceInfo(f'http://{flight_service_host}:{flight_service_port}', *upstream_args)
+        self._ticket_service_info = ServiceInfo(f'http://{ticket_service_host}:{ticket_service_port}', *upstream_args)
+        self._bonus_service_info = ServiceInfo(f'http://{bonus_service_host}:{bonus_service_port}', *upstream_args)
+        self._stats_service_info = ServiceInfo(f'http://{stats_service_host}:{stats_service_port}', *upstream_args)
+
+        self._register_upstream('flight', self._flight_service_info.session)
+        self._register_upstream('ticket', self._ticket_service_info.session)
+        self._register_upstream('bonus', self._bonus_service_info.session)
+        self._register_upstream('stats', self._stats_service_info.session)
 
         self._valid_error_level = valid_error_level
         self._wait_before_retry = wait_before_retry
@@ -76,6 +81,9 @@ class Gateway(ServerBaseWithKeycloak):
 
         self._authorization_required = authorization_required
 
+        self._admins_cache = TtlLruCache(1, self.admins_cache_ttl_s)
+        self._register_cache('admins', self._admins_cache)
+
     ################################################################################################
 
     @ServerBaseWithKeycloak.route(path='/api/v1/flights', methods=ALL_METHODS)
@@ -128,75 +136,31 @@ class Gateway(ServerBaseWithKeycloak):
 
     @ServerBaseWithKeycloak.route(path='/api/v1/stats', methods=['GET'])
     def _stats(self):
-        request = flask_request
-
-        if self._authorization_required:
-            token = self._get_user_token_from(request)
-            username = self._get_username_by(token)
-
-            admins = [i['username'] for i in self._keycloak_admin.get_realm_role_members('admin')]
-            if username not in admins:
-                raise UserError('only admin user can view stats', 403)
-
-        else:
-            self._logger.warn("Authorization check disabled")
+        self._check_admin(flask_request, 'only admin user can view stats')
 
         return self._resend(
             self._stats_service_info, f'/api/v1/stats', flask_request
         )   
 
+    @ServerBaseWithKeycloak.route(path='/api/v1/stats/latency', methods=['GET'])
+    def _stats_latency(self):
+        self._check_admin(flask_request, 'only admin user can view stats')
+
+        return self._resend(
+            self._stats_service_info, f'/api/v1/stats/latency', flask_request
+        )
+
     ################################################################################################
 
     @ServerBaseWithKeycloak.route(path='/api/v1/authorize', methods=['POST'])
     def _authorize(self):
-        request = flask_request
-
-        with UserValue.ErrorChain() as error_chain:
-            username = UserValue.get_from(request.json, 'username', error_chain).expected(str).value
-            password = UserValue.get_from(request.json, 'password', error_chain).expected(str).value
-
-        try:
-            token = self._get_user_token_by(username, password)
-        except KeycloakAuthenticationError as error:
-            if error.response_code == 401:
-                raise UserError('invalid user credentials', 401)
-
-        return make_response(token, 200)
+        return make_response(self._authorize_user(flask_request.json), 200)
 
     @ServerBaseWithKeycloak.route(path='/api/v1/register', methods=['POST'])
     def _register(self):
-        request = flask_request
-
-        if self._authorization_required:
-            token = self._get_user_token_from(request)
-            username = self._get_username_by(token)
-
-            admins = [i['username'] for i in self._keycloak_admin.get_realm_role_members('admin')]
-            if username not in admins:
-                raise UserError('only admin user can register', 403)
+        self._check_admin(flask_request, 'only admin user can register')
 
-        else:
-            self._logger.warn("Authorization check disabled")
-
-        with UserValue.ErrorChain() as error_chain:
-            username = UserValue.get_from(request.json, 'username', error_chain).expected(str).value
-            password = UserValue.get_from(request.json, 'password', error_chain).expected(str).value
-
-        try:
-            self._keycloak_admin.create_user(
-                {
-                    'username': username,
-                    'enabled': True,
-                    'credentials': [{'value': password, 'type': 'password'}]
-                },
-                exist_ok=False
-            )
-
-        except KeycloakPostError as error:
-            if error.response_code == 409:
-                raise UserError('already used username', 409)
-
-        return make_response(self._get_user_token_by(username, password), 200)
+        return make_response(self._register_user(flask_request.json), 200)
 
     @ServerBaseWithKeycloak.route(path='/api/v1/callback', methods=ALL_METHODS)
     def _callback(self):
@@ -205,10 +169,7 @@ class Gateway(ServerBaseWithKeycloak):
     ################################################################################################
 
     def _resend(self, service_info, path, request):
-        if self._authorization_required:
-            self._get_user_token_from(request)
-        else:
-            self._logger.warn("Authorization check disabled")
+        self._check_authorization(request)
 
         try:
             if len(service_info.queue) != 0:
@@ -223,14 +184,6 @@ class Gateway(ServerBaseWithKeycloak):
         
         except Exception:
             if request.method == 'DELETE':
-                class RequestBackup:
-                    def __init__(self, path, method, headers, args, data):
-                        self.path = path
-                        self.method = method
-                        self.headers = headers
-                        self.args = args
-                        self.data = data
-
                 service_info.queue.append(RequestBackup(path, request.method, request.headers, request.args, request.data))
 
                 return make_response('', 200)
@@ -242,15 +195,15 @@ class Gateway(ServerBaseWithKeycloak):
 
         try:
             self._logger.debug('Send request')
-            response = requests.request(
+            response = service_info.session.request(
                 method,
-                f'{service_info.url}{path}',
+                path,
                 headers=request.headers,
                 params=request.args,
                 data=request.data
             )
 
-            service_info.error_level = 0
+            service_info.on_success()
             self._logger.debug(f'Got response from service, reset error level to 0')
 
             if tools.is_json_content(response):
@@ -261,25 +214,23 @@ class Gateway(ServerBaseWithKeycloak):
         except Exception as error:
             self._logger.error(f'Failed to send request, error: {error}')
 
-            service_info.error_level = min(service_info.error_level, self._valid_error_level) + 1
+            service_info.on_failure(self._valid_error_level)
             self._logger.debug(f'Error level: {service_info.error_level}')
-            self._last_error_time = int(time())
 
             raise
 
     def _check_service_health(self, service_info: ServiceInfo):
-        if service_info.error_level > self._valid_error_level:
-            if service_info.last_error_time + self._wait_before_retry > int(time()):
-                self._logger.error(
-                    f'Failed to send request to {service_info.url}, '
-                    f'error level {service_info.error_level} > {self._valid_error_level} '
-                    f'for {self._wait_before_retry}s from last {service_info.last_error_time}'
-                )
-            
-                return False
+        if service_info.is_circuit_open(self._valid_error_level, self._wait_before_retry):
+            self._logger.error(
+                f'Failed to send request to {service_info.url}, '
+                f'error level {service_info.error_level} > {self._valid_error_level} '
+                f'for {self._wait_before_retry}s from last {service_info.last_error_time}'
+            )
+        
+            return False
          
         try:
-            requests.request('GET', f'{service_info.url}/manage/health')
+            service_info.session.request('GET', '/manage/health')
 
         except:
             return False
@@ -289,6 +240,79 @@ class Gateway(ServerBaseWithKeycloak):
     # Helpers
     ####################################################################################################################
 
+    def _check_authorization(self, request):
+        if self._authorization_required:
+            self._get_user_token_from(request)
+        else:
+            self._logger.warn("Authorization check disabled")
+
+    def _check_admin(self, request, message):
+        if self._authorization_required:
+            token = self._get_user_token_from(request)
+
+            if not self._is_admin(token):
+                raise UserError(message, 403)
+
+        else:
+            self._logger.warn("Authorization check disabled")
+
+    def _check_manage_cache_access(self, request):
+        self._check_admin(request, 'only admin user can invalidate caches')
+
+    def _authorize_user(self, body):
+        with UserValue.ErrorChain() as error_chain:
+            username = UserValue.get_from(body, 'username', error_chain).expected(str).value
+            password = UserValue.get_from(body, 'password', error_chain).expected(str).value
+
+        try:
+            return self._get_user_token_by(username, password)
+
+        except KeycloakAuthenticationError as error:
+            if error.response_code == 401:
+                raise UserError('invalid user credentials', 401)
+
+            raise
+
+    def _register_user(self, body):
+        with UserValue.ErrorChain() as error_chain:
+            username = UserValue.get_from(body, 'username', error_chain).expected(str).value
+            password = UserValue.get_from(body, 'password', error_chain).expected(str).value
+
+        try:
+            self._keycloak_admin.create_user(
+                {
+                    'username': username,
+                    'enabled': True,
+                    'credentials': [{'value': password, 'type': 'password'}]
+                },
+                exist_ok=False
+            )
+
+        except KeycloakPostError as error:
+            if error.response_code == 409:
+                raise UserError('already used username', 409)
+
+        return self._get_user_token_by(username, password)
+
+    def _is_admin(self, token):
+        claims = self._validate_token(token)
+
+        if 'realm_access' in claims:
+            return self.admin_role in claims['realm_access'].get('roles', [])
+
+        return self._get_username_by(token) in self._get_admins()
+
+    def _get_admins(self):
+        admins = self._admins_cache.get(self.admin_role)
+
+        if admins is None:
+            self._logger.info(f'Fetch members of realm role \'{self.admin_role}\'')
+
+            admins = frozenset(i['username'] for i in self._keycloak_admin.get_realm_role_members(self.admin_role))
+            self._admins_cache.put(self.admin_role, admins)
+
+        return admins
+
     def _register_routes(self):
         self._register_route('_flight')
         self._register_route('_flight_aPath')
@@ -301,6 +325,7 @@ class Gateway(ServerBaseWithKeycloak):
         self._register_route('_callback')
         self._register_route('_register')
         self._register_route('_stats')
+        self._register_route('_stats_latency')
 
 
 if __name__ == '__main__':
@@ -325,8 +350,19 @@ if __name__ == '__main__':
     parser.add_argument('--oidc-client-secret', type=str, required=True)
     parser.add_argument('--kafka-host', type=str, default='localhost')
     parser.add_argument('--kafka-port', type=str, default=29092)
+    parser.add_argument('--kafka-linger-ms', type=int, default=50)
+    parser.add_argument('--kafka-compression', type=str, default='gzip')
     parser.add_argument('--debug', action='store_true')
+    parser.add_argument('--server', type=str, choices=['flask', 'gunicorn'], default='flask')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--backlog', type=int, default=2048)
+    parser.add_argument('--graceful-timeout', type=int, default=30)
     parser.add_argument('--no-authorization', action='store_true')
+    parser.add_argument('--upstream-pool-size', type=int, default=32)
+    parser.add_argument('--upstream-connect-timeout', type=float, default=3)
+    parser.add_argument('--upstream-read-timeout', type=float, default=30)
+    parser.add_argument('--async-proxy', action='store_true')
 
     cmd_args = parser.parse_args()
 
@@ -357,8 +393,32 @@ if __name__ == '__main__':
         cmd_args.oidc_client_secret,
         'admin',
         'admin',
-        KafkaProducer(bootstrap_servers=f'{cmd_args.kafka_host}:{cmd_args.kafka_port}'),
-        not cmd_args.no_authorization
+        KafkaProducer(
+            bootstrap_servers=f'{cmd_args.kafka_host}:{cmd_args.kafka_port}',
+            linger_ms=cmd_args.kafka_linger_ms,
+            compression_type=cmd_args.kafka_compression
+        ),
+        not cmd_args.no_authorization,
+        cmd_args.upstream_pool_size,
+        cmd_args.upstream_connect_timeout,
+        cmd_args.upstream_read_timeout
     )
 
-    gateway.run(cmd_args.debug)
+    if cmd_args.async_proxy:
+        from async_gateway import AsyncGateway
+
+        AsyncGateway(
+            gateway,
+            cmd_args.upstream_pool_size,
+            cmd_args.upstream_connect_timeout,
+            cmd_args.upstream_read_timeout
+        ).run(cmd_args.backlog)
+    else:
+        gateway.run(
+            cmd_args.debug,
+            cmd_args.server,
+            cmd_args.workers,
+            cmd_args.threads,
+            cmd_args.backlog,
+            cmd_args.graceful_timeout
+        )
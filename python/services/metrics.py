@@ -0,0 +1,187 @@
+from collections import Counter
+
+import math
+import threading
+
+SUB_BUCKET_BITS = 5
+SUB_BUCKET_COUNT = 1 << SUB_BUCKET_BITS
+
+METRICS_TOPIC = 'RequestMetrics'
+
+
+class Histogram:
+    # log-linear buckets over microseconds, relative error is bounded by 1 / SUB_BUCKET_COUNT
+    def __init__(self, counts=None, sum_us=0):
+        self.counts = Counter(counts or {})
+        self.sum_us = sum_us
+
+    @staticmethod
+    def bucket_index(value_us):
+        value = max(int(value_us), 0)
+        exponent = value.bit_length() - 1
+
+        if exponent < SUB_BUCKET_BITS:
+            return value
+
+        mantissa = (value >> (exponent - SUB_BUCKET_BITS)) & (SUB_BUCKET_COUNT - 1)
+
+        return (exponent - SUB_BUCKET_BITS + 1) * SUB_BUCKET_COUNT + mantissa
+
+    @staticmethod
+    def bucket_bounds(index):
+        if index < SUB_BUCKET_COUNT:
+            return index, index + 1
+
+        group, mantissa = divmod(index, SUB_BUCKET_COUNT)
+        lower = (SUB_BUCKET_COUNT + mantissa) << (group - 1)
+
+        return lower, lower + (1 << (group - 1))
+
+    @property
+    def total(self):
+        return sum(self.counts.values())
+
+    def record(self, value_us, count=1):
+        self.counts[self.bucket_index(value_us)] += count
+        self.sum_us += value_us * count
+
+    def merge(self, counts):
+        for index, count in counts.items():
+            self.counts[int(index)] += count
+
+    def percentile(self, quantile):
+        total = self.total
+
+        if total == 0:
+            return None
+
+        target = max(math.ceil(quantile * total), 1)
+
+        cumulative = 0
+        for index in sorted(self.counts):
+            cumulative += self.counts[index]
+
+            if cumulative >= target:
+                lower, upper = self.bucket_bounds(index)
+                return (lower + upper) / 2
+
+        return None
+
+
+class TimingMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+
+    def record(self, name, duration_s):
+        with self._lock:
+            histogram = self._histograms.get(name)
+
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+
+            histogram.record(duration_s * 1_000_000)
+
+    def snapshot(self):
+        with self._lock:
+            return {name: Histogram(histogram.counts, histogram.sum_us) for name, histogram in self._histograms.items()}
+
+
+class RequestMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+
+        self._histograms = {}
+        self._outcomes = Counter()
+
+        self._pending_histograms = {}
+        self._pending_outcomes = Counter()
+
+    def record(self, method, path, latency_s, status, error):
+        latency_us = latency_s * 1_000_000
+
+        with self._lock:
+            for histograms, outcomes in (
+                (self._histograms, self._outcomes),
+                (self._pending_histograms, self._pending_outcomes)
+            ):
+                histogram = histograms.get((method, path))
+
+                if histogram is None:
+                    histogram = histograms[(method, path)] = Histogram()
+
+                histogram.record(latency_us)
+                outcomes[(method, path, status, error)] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return (
+                {key: Histogram(histogram.counts, histogram.sum_us) for key, histogram in self._histograms.items()},
+                Counter(self._outcomes)
+            )
+
+    def take_pending(self):
+        with self._lock:
+            histograms, outcomes = self._pending_histograms, self._pending_outcomes
+
+            self._pending_histograms = {}
+            self._pending_outcomes = Counter()
+
+        reports = []
+        for (method, path), histogram in histograms.items():
+            reports.append(
+                {
+                    'method': method,
+                    'path': path,
+                    'histogram': dict(histogram.counts),
+                    'outcomes': [
+                        {'status': status, 'error': error, 'count': count}
+                        for (outcome_method, outcome_path, status, error), count in outcomes.items()
+                        if outcome_method == method and outcome_path == path
+                    ]
+                }
+            )
+
+        return reports
+
+
+class PrometheusText:
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+    duration_buckets_s = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+    def __init__(self):
+        self._lines = []
+
+    def metric(self, name, metric_type, description):
+        self._lines.append(f'# HELP {name} {description}')
+        self._lines.append(f'# TYPE {name} {metric_type}')
+
+    def sample(self, name, labels, value):
+        if len(labels) != 0:
+            labels = ','.join(f'{key}="{self._escape(label_value)}"' for key, label_value in labels.items())
+            name = f'{name}{{{labels}}}'
+
+        self._lines.append(f'{name} {value}')
+
+    def histogram(self, name, labels, histogram):
+        counts = sorted(histogram.counts.items())
+
+        cumulative = 0
+        position = 0
+        for bucket_s in self.duration_buckets_s:
+            while position < len(counts) and Histogram.bucket_bounds(counts[position][0])[1] <= bucket_s * 1_000_000:
+                cumulative += counts[position][1]
+                position += 1
+
+            self.sample(f'{name}_bucket', {**labels, 'le': bucket_s}, cumulative)
+
+        self.sample(f'{name}_bucket', {**labels, 'le': '+Inf'}, histogram.total)
+        self.sample(f'{name}_sum', labels, histogram.sum_us / 1_000_000)
+        self.sample(f'{name}_count', labels, histogram.total)
+
+    def render(self):
+        return '\n'.join(self._lines) + '\n'
+
+    @staticmethod
+    def _escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1 @@
+CREATE UNIQUE INDEX IF NOT EXISTS flight_number_idx ON flight (number);
@@ -0,0 +1 @@
+ALTER TABLE flight ADD COLUMN IF NOT EXISTS capacity INT NOT NULL DEFAULT 3 CHECK (capacity >= 0);
@@ -0,0 +1,2 @@
+CREATE INDEX IF NOT EXISTS privilege_history_privilege_id_idx ON privilege_history (privilege_id, id);
+CREATE INDEX IF NOT EXISTS privilege_history_ticket_uid_idx ON privilege_history (ticket_uid);
@@ -0,0 +1,36 @@
+CREATE TABLE IF NOT EXISTS stat_minute
+(
+    id      SERIAL PRIMARY KEY,
+    service VARCHAR(80) NOT NULL,
+    path    VARCHAR(80) NOT NULL,
+    method  VARCHAR(80) NOT NULL CHECK (method IN ('GET', 'POST', 'DELETE')),
+    bucket  TIMESTAMP   NOT NULL,
+    count   INT         NOT NULL DEFAULT 0,
+    UNIQUE(service, method, path, bucket)
+);
+
+CREATE TABLE IF NOT EXISTS stat_hour
+(
+    id      SERIAL PRIMARY KEY,
+    service VARCHAR(80) NOT NULL,
+    path    VARCHAR(80) NOT NULL,
+    method  VARCHAR(80) NOT NULL CHECK (method IN ('GET', 'POST', 'DELETE')),
+    bucket  TIMESTAMP   NOT NULL,
+    count   INT         NOT NULL DEFAULT 0,
+    UNIQUE(service, method, path, bucket)
+);
+
+CREATE TABLE IF NOT EXISTS stat_day
+(
+    id      SERIAL PRIMARY KEY,
+    service VARCHAR(80) NOT NULL,
+    path    VARCHAR(80) NOT NULL,
+    method  VARCHAR(80) NOT NULL CHECK (method IN ('GET', 'POST', 'DELETE')),
+    bucket  TIMESTAMP   NOT NULL,
+    count   INT         NOT NULL DEFAULT 0,
+    UNIQUE(service, method, path, bucket)
+);
+
+CREATE INDEX IF NOT EXISTS stat_minute_bucket_idx ON stat_minute (bucket);
+CREATE INDEX IF NOT EXISTS stat_hour_bucket_idx ON stat_hour (bucket);
+CREATE INDEX IF NOT EXISTS stat_day_bucket_idx ON stat_day (bucket);
@@ -0,0 +1,10 @@
+CREATE TABLE IF NOT EXISTS latency
+(
+    id           SERIAL PRIMARY KEY,
+    service      VARCHAR(80) NOT NULL,
+    path         VARCHAR(80) NOT NULL,
+    method       VARCHAR(80) NOT NULL CHECK (method IN ('GET', 'POST', 'DELETE')),
+    bucket_index INT         NOT NULL,
+    count        BIGINT      NOT NULL DEFAULT 0,
+    UNIQUE(service, method, path, bucket_index)
+);
@@ -0,0 +1,11 @@
+CREATE TABLE IF NOT EXISTS request_outcome
+(
+    id      SERIAL PRIMARY KEY,
+    service VARCHAR(80) NOT NULL,
+    path    VARCHAR(80) NOT NULL,
+    method  VARCHAR(80) NOT NULL CHECK (method IN ('GET', 'POST', 'DELETE')),
+    status  INT         NOT NULL,
+    error   VARCHAR(80) NOT NULL DEFAULT '',
+    count   BIGINT      NOT NULL DEFAULT 0,
+    UNIQUE(service, method, path, status, error)
+);
@@ -0,0 +1,8 @@
+CREATE TABLE IF NOT EXISTS stat_rollup_pending
+(
+    bucket TIMESTAMP PRIMARY KEY
+);
+
+INSERT INTO stat_rollup_pending(bucket)
+    SELECT DISTINCT date_trunc('hour', bucket) FROM stat_minute
+ON CONFLICT DO NOTHING;
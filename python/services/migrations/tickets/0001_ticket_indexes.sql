@@ -0,0 +1,2 @@
+CREATE INDEX IF NOT EXISTS ticket_username_idx ON ticket (username);
+CREATE INDEX IF NOT EXISTS ticket_flight_number_status_idx ON ticket (flight_number, status);
@@ -0,0 +1,6 @@
+CREATE TABLE IF NOT EXISTS flight_seat
+(
+    flight_number VARCHAR(20) PRIMARY KEY,
+    capacity      INT         NOT NULL CHECK (capacity >= 0),
+    available     INT         NOT NULL CHECK (available >= 0)
+);
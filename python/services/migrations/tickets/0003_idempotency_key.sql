@@ -0,0 +1,11 @@
+CREATE TABLE IF NOT EXISTS idempotency_key
+(
+    username     VARCHAR(80)  NOT NULL,
+    key          VARCHAR(255) NOT NULL,
+    request_hash VARCHAR(64)  NOT NULL,
+    response     JSONB,
+    created_at   TIMESTAMP    NOT NULL DEFAULT now(),
+    PRIMARY KEY (username, key)
+);
+
+CREATE INDEX IF NOT EXISTS idempotency_key_created_at_idx ON idempotency_key (created_at);
@@ -0,0 +1,82 @@
+import os
+import re
+import zlib
+
+import tools
+
+MIGRATIONS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+MIGRATION_FILE_PATTERN = re.compile(r'^(\d+)_(\w+)\.sql$')
+
+
+class MigrationRunner:
+    def __init__(self, logger, name, path=MIGRATIONS_PATH):
+        self._logger = logger
+
+        self._name = name
+        self._path = os.path.join(path, name)
+
+    def load(self):
+        if not os.path.isdir(self._path):
+            return []
+
+        migrations = []
+        for file_name in sorted(os.listdir(self._path)):
+            match = MIGRATION_FILE_PATTERN.match(file_name)
+
+            if match is None:
+                continue
+
+            with open(os.path.join(self._path, file_name), encoding='utf-8') as file:
+                migrations.append((int(match.group(1)), match.group(2), file.read()))
+
+        return sorted(migrations)
+
+    def apply(self, connection):
+        migrations = self.load()
+
+        if len(migrations) == 0:
+            return
+
+        # replicas starting at the same time wait for the first one to finish
+        lock_id = zlib.crc32(f'migrations {self._name}'.encode('utf-8'))
+
+        cursor = connection.cursor()
+        cursor.execute('SELECT pg_advisory_lock(%s)', (lock_id,))
+
+        try:
+            cursor.execute(
+                tools.simplify_sql_query(
+                    f'CREATE TABLE IF NOT EXISTS schema_migration '
+                    f'( '
+                    f'    version    INT PRIMARY KEY, '
+                    f'    name       VARCHAR(255) NOT NULL, '
+                    f'    applied_at TIMESTAMP    NOT NULL DEFAULT now() '
+                    f')'
+                )
+            )
+            connection.commit()
+
+            cursor.execute('SELECT version FROM schema_migration')
+            applied = {row[0] for row in cursor.fetchall()}
+
+            for version, name, query in migrations:
+                if version in applied:
+                    continue
+
+                self._logger.info(f'Apply migration {version} {name} to {self._name}')
+
+                try:
+                    cursor.execute(query)
+                    cursor.execute('INSERT INTO schema_migration(version, name) VALUES(%s, %s)', (version, name))
+                    connection.commit()
+
+                except Exception:
+                    connection.rollback()
+
+                    raise
+
+        finally:
+            cursor.execute('SELECT pg_advisory_unlock(%s)', (lock_id,))
+            connection.commit()
+
+            cursor.close()
@@ -0,0 +1,19 @@
+# route templates of every service, request events carry only their crc32 ids
+ROUTES = [
+    '/api/v1/authorize',
+    '/api/v1/callback',
+    '/api/v1/flights',
+    '/api/v1/flights/<path:path>',
+    '/api/v1/flights/<string:number>',
+    '/api/v1/flights/batch',
+    '/api/v1/me',
+    '/api/v1/privilege',
+    '/api/v1/privilege/<path:path>',
+    '/api/v1/privilege/<string:ticket_uid>',
+    '/api/v1/register',
+    '/api/v1/stats',
+    '/api/v1/stats/latency',
+    '/api/v1/tickets',
+    '/api/v1/tickets/<path:path>',
+    '/api/v1/tickets/<string:uid>'
+]
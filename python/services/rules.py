@@ -10,6 +10,12 @@ def greate_equal_zero(value):
 
     return None
 
+def not_empty(value):
+    if len(value) == 0:
+        return 'value must be not empty'
+
+    return None
+
 def json_content(content_type):
     if content_type != 'application/json':
         return 'invalid header: \'Content-Type\''
@@ -5,32 +5,230 @@ from base import DbConnectorBase
 
 import tools
 
+import psycopg2.extras
+
+from flask import request
 from flask import make_response
 
+from getters import UserValue
+from metrics import Histogram, METRICS_TOPIC
+from telemetry import EventDecoder
+
 import argparse
 
-from threading import Thread
+from threading import Thread, Lock, Event
+from collections import Counter
+
+import time
+import json
+import queue
+from datetime import datetime, timedelta, timezone
 
-from kafka import KafkaConsumer, TopicPartition
+from kafka import KafkaConsumer, ConsumerRebalanceListener
+from kafka.structs import OffsetAndMetadata
 
 class StatsDbConnector(DbConnectorBase):
-    def __init__(self, host, port, database, user, password, sslmode='disable'):
-        super().__init__('StatsDbConnector', host, port, database, user, password, sslmode)
+    migrations = 'stats'
 
-    def tick(self, service, method, path):
-        query = tools.simplify_sql_query(
+    def __init__(self, host, port, database, user, password, sslmode='disable', pool_min=1, pool_max=10):
+        super().__init__('StatsDbConnector', host, port, database, user, password, sslmode, pool_min, pool_max)
+
+    # stat tables only accept these methods, see the method CHECK constraints
+    methods = ('GET', 'POST', 'DELETE')
+
+    granularities = {
+        'minute': 'stat_minute',
+        'hour': 'stat_hour',
+        'day': 'stat_day'
+    }
+
+    retentions = {
+        'stat_minute': '2 days',
+        'stat_hour': '90 days',
+        'stat_day': '5 years'
+    }
+
+    def add_batch(self, batch):
+        totals = Counter()
+        for (service, method, path, bucket), count in batch.counts.items():
+            totals[(service, method, path)] += count
+
+        total_query = tools.simplify_sql_query(
             f'INSERT INTO stat(service, method, path, count) '
-            f'VALUES(\'{service}\', \'{method}\', \'{path}\', 1) '
+            f'VALUES %s '
             f'ON CONFLICT (service, method, path) DO UPDATE '
-            f'SET count = stat.count + 1'
+            f'SET count = stat.count + EXCLUDED.count'
         )
-        
+
+        bucket_query = tools.simplify_sql_query(
+            f'INSERT INTO stat_minute(service, method, path, bucket, count) '
+            f'VALUES %s '
+            f'ON CONFLICT (service, method, path, bucket) DO UPDATE '
+            f'SET count = stat_minute.count + EXCLUDED.count'
+        )
+
+        latency_query = tools.simplify_sql_query(
+            f'INSERT INTO latency(service, method, path, bucket_index, count) '
+            f'VALUES %s '
+            f'ON CONFLICT (service, method, path, bucket_index) DO UPDATE '
+            f'SET count = latency.count + EXCLUDED.count'
+        )
+
+        outcome_query = tools.simplify_sql_query(
+            f'INSERT INTO request_outcome(service, method, path, status, error, count) '
+            f'VALUES %s '
+            f'ON CONFLICT (service, method, path, status, error) DO UPDATE '
+            f'SET count = request_outcome.count + EXCLUDED.count'
+        )
+
+        # the row lock is held until commit, so a concurrent rollup waits for this batch before reading its hours
+        pending_query = tools.simplify_sql_query(
+            f'INSERT INTO stat_rollup_pending(bucket) '
+            f'VALUES %s '
+            f'ON CONFLICT (bucket) DO UPDATE SET bucket = EXCLUDED.bucket'
+        )
+
+        hours = {(bucket.replace(minute=0),) for (service, method, path, bucket) in batch.counts}
+
+        with self._connection() as connection:
+            cursor = connection.cursor()
+
+            # rows are locked in key order, so concurrent workers upserting the same keys do not deadlock
+            for query, rows in (
+                (total_query, sorted(key + (count,) for key, count in totals.items())),
+                (bucket_query, sorted(key + (count,) for key, count in batch.counts.items())),
+                (latency_query, sorted(key + (count,) for key, count in batch.latencies.items())),
+                (outcome_query, sorted(key + (count,) for key, count in batch.outcomes.items())),
+                (pending_query, sorted(hours))
+            ):
+                if len(rows) == 0:
+                    continue
+
+                self._logger.debug(f'Execute query: {query} with {len(rows)} rows')
+                psycopg2.extras.execute_values(cursor, query, rows)
+
+            cursor.close()
+            connection.commit()
+
+    def rollup(self):
+        # hours touched by batches since the last rollup, including late events, so an outage leaves no gaps, but
+        # not hours partly removed by the stat_minute retention, which would be recomputed from incomplete minutes
+        pending_query = tools.simplify_sql_query(
+            f'WITH pending AS (DELETE FROM stat_rollup_pending RETURNING bucket) '
+            f'SELECT bucket FROM pending '
+            f'WHERE bucket > now() AT TIME ZONE \'UTC\' - interval \'{self.retentions["stat_minute"]}\' '
+            f'ORDER BY bucket'
+        )
+
+        hour_query = tools.simplify_sql_query(
+            f'INSERT INTO stat_hour(service, method, path, bucket, count) '
+            f'    SELECT service, method, path, pending.bucket, SUM(count) '
+            f'    FROM unnest(%s::timestamp[]) pending(bucket) '
+            f'    JOIN stat_minute ON pending.bucket <= stat_minute.bucket '
+            f'        AND stat_minute.bucket < pending.bucket + interval \'1 hour\' '
+            f'    GROUP BY service, method, path, pending.bucket '
+            f'ON CONFLICT (service, method, path, bucket) DO UPDATE SET count = EXCLUDED.count'
+        )
+
+        day_query = tools.simplify_sql_query(
+            f'INSERT INTO stat_day(service, method, path, bucket, count) '
+            f'    SELECT service, method, path, pending.bucket, SUM(count) '
+            f'    FROM unnest(%s::timestamp[]) pending(bucket) '
+            f'    JOIN stat_hour ON pending.bucket <= stat_hour.bucket '
+            f'        AND stat_hour.bucket < pending.bucket + interval \'1 day\' '
+            f'    GROUP BY service, method, path, pending.bucket '
+            f'ON CONFLICT (service, method, path, bucket) DO UPDATE SET count = EXCLUDED.count'
+        )
+
+        retention_query = ' '.join(
+            f'DELETE FROM {table} WHERE bucket < now() AT TIME ZONE \'UTC\' - interval \'{retention}\';'
+            for table, retention in self.retentions.items()
+        )
+
+        with self._connection() as connection:
+            cursor = connection.cursor()
+
+            self._logger.debug(f'Execute query: {pending_query}')
+            cursor.execute(pending_query)
+
+            hours = [row[0] for row in cursor.fetchall()]
+            days = sorted({hour.replace(hour=0) for hour in hours})
+
+            if len(hours) != 0:
+                self._logger.debug(f'Execute query: {hour_query} for {len(hours)} hours')
+                cursor.execute(hour_query, (hours,))
+
+                self._logger.debug(f'Execute query: {day_query} for {len(days)} days')
+                cursor.execute(day_query, (days,))
+
+            self._logger.debug(f'Execute query: {retention_query}')
+            cursor.execute(retention_query)
+
+            cursor.close()
+            connection.commit()
+
+    def get_stat_buckets(self, granularity, from_time, to_time):
+        query = tools.simplify_sql_query(
+            f'SELECT service, method, path, bucket, count FROM {self.granularities[granularity]} '
+            f'WHERE %s <= bucket AND bucket < %s '
+            f'ORDER BY bucket, service, method, path'
+        )
+
         self._logger.debug(f'Execute query: {query}')
-        cursor = self._connection.cursor()
-        cursor.execute(query)
+        with self._connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute(query, (from_time, to_time))
+
+            table = cursor.fetchall()
+            cursor.close()
+
+        return [
+            { 'endpoint': f'{row[0]} {row[1]} {row[2]}', 'time': row[3].isoformat(), 'count': row[4] }
+            for row in table
+        ]
+
+    def get_latency(self):
+        latency_query = tools.simplify_sql_query(
+            'SELECT service, method, path, bucket_index, count FROM latency'
+        )
+
+        outcome_query = tools.simplify_sql_query(
+            'SELECT service, method, path, status, error, count FROM request_outcome'
+        )
+
+        self._logger.debug(f'Execute query: {latency_query}')
+        self._logger.debug(f'Execute query: {outcome_query}')
+        with self._connection() as connection:
+            cursor = connection.cursor()
+
+            cursor.execute(latency_query)
+            latency_table = cursor.fetchall()
+
+            cursor.execute(outcome_query)
+            outcome_table = cursor.fetchall()
+
+            cursor.close()
+
+        histograms = {}
+        for service, method, path, bucket_index, count in latency_table:
+            histograms.setdefault(f'{service} {method} {path}', Histogram()).counts[bucket_index] += count
 
-        cursor.close()
-        self._connection.commit()
+        outcomes = {}
+        for service, method, path, status, error, count in outcome_table:
+            outcome = f'{status} {error}' if error != '' else f'{status}'
+            outcomes.setdefault(f'{service} {method} {path}', {})[outcome] = count
+
+        return [
+            {
+                'endpoint': endpoint,
+                'count': histogram.total,
+                'p50': histogram.percentile(0.50) / 1000,
+                'p95': histogram.percentile(0.95) / 1000,
+                'p99': histogram.percentile(0.99) / 1000,
+                'outcomes': outcomes.get(endpoint, {})
+            }
+            for endpoint, histogram in histograms.items()
+        ]
 
     def get_stat(self):
         query = tools.simplify_sql_query(
@@ -38,69 +236,444 @@ class StatsDbConnector(DbConnectorBase):
         )
                                          
         self._logger.debug(f'Execute query: {query}')
-        cursor = self._connection.cursor()
-        cursor.execute(query)
+        with self._connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute(query)
 
-        table = cursor.fetchall()
-        cursor.close()
+            table = cursor.fetchall()
+            cursor.close()
         return [
             { 'endpoint': f'{row[0]} {row[1]} {row[2]}', 'count': row[3] }
             for row in table
         ]
 
+class StatsBatch:
+    def __init__(self):
+        self.counts = Counter()
+        self.latencies = Counter()
+        self.outcomes = Counter()
+
+        self.events_count = 0
+        self.dropped_count = 0
+
+    def is_empty(self):
+        return len(self.counts) == 0 and len(self.latencies) == 0 and len(self.outcomes) == 0
+
+    def add_event(self, service, payload, decoder):
+        event = decoder.decode(service, payload.value, payload.timestamp)
+
+        if event is None:
+            return
+
+        if event.method not in StatsDbConnector.methods:
+            self.dropped_count += 1
+            return
+
+        bucket = datetime.utcfromtimestamp(event.timestamp_ms / 1000).replace(second=0, microsecond=0)
+
+        self.counts[(service, event.method, event.path, bucket)] += 1
+        self.events_count += 1
+
+    def add_report(self, payload):
+        report = json.loads(payload.value.decode('utf-8'))
+
+        if report['method'] not in StatsDbConnector.methods:
+            self.dropped_count += 1
+            return
+
+        endpoint = (report['service'], report['method'], report['path'])
+
+        for bucket_index, count in report['histogram'].items():
+            self.latencies[endpoint + (int(bucket_index),)] += count
+
+        for outcome in report['outcomes']:
+            self.outcomes[endpoint + (outcome['status'], outcome['error'])] += outcome['count']
+
+        self.events_count += 1
+
+
 class StatsService(ServiceBase):
-    def __init__(self, host, port, db_connector, kafka_consumer: KafkaConsumer):
-        super().__init__('StatsService', host, port, db_connector)
+    topics = ['FlightService', 'TicketService', 'BounsService', 'Gateway', METRICS_TOPIC]
+
+    kafka_stop_timeout_s = 10
+
+    def __init__(
+        self,
+        host,
+        port,
+        db_connector,
+        kafka_consumer: KafkaConsumer,
+        flush_size=1000,
+        flush_interval_s=1,
+        rollup_interval_s=60,
+        consumer_workers=4,
+        revoke_warning_interval_s=30,
+        manage_token=None
+    ):
+        super().__init__('StatsService', host, port, db_connector, manage_token=manage_token)
         
         self._kafka_consumer = kafka_consumer
-        self._kafka_thread = Thread(target=self._kafka_job)
+        self._flush_interval_s = flush_interval_s
+        self._rollup_interval_s = rollup_interval_s
+
+        self._revoke_warning_interval_s = revoke_warning_interval_s
+
+        self._committable = {}
+        self._committable_lock = Lock()
+
+        self._workers = [
+            StatsWorker(
+                f'{self._service_name} worker {index}',
+                db_connector,
+                self._on_flushed,
+                flush_size,
+                flush_interval_s
+            )
+            for index in range(consumer_workers)
+        ]
+        # poll blocks while no broker is reachable, so the thread must not keep the process alive
+        self._kafka_thread = Thread(target=self._kafka_job, daemon=True)
+        self._kafka_job_done = Event()
 
         self._is_running = False
         
-    def run(self, *args):
+    def run(self, debug=False, server='flask', workers=1, threads=1, backlog=2048, graceful_timeout_s=30):
+        if server == 'gunicorn':
+            # the consumer runs in the worker, more workers would consume and count the same partitions twice
+            if workers != 1:
+                self._logger.warning(f'Run 1 gunicorn worker instead of {workers}, kafka consumer must run once')
+                workers = 1
+        else:
+            self._start_kafka_job()
+
+        try:
+            super().run(debug, server, workers, threads, backlog, graceful_timeout_s)
+
+        finally:
+            self._stop_kafka_job()
+
+    def _after_fork(self):
+        super()._after_fork()
+
+        self._start_kafka_job()
+
+    def _on_worker_exit(self):
+        self._stop_kafka_job()
+
+        super()._on_worker_exit()
+
+    def _start_kafka_job(self):
         self._is_running = True
         self._kafka_thread.start()
-        super().run(*args)
+
+    def _stop_kafka_job(self):
+        if not self._is_running:
+            return
 
         self._is_running = False
-        self._kafka_thread.join()
+
+        if not self._kafka_job_done.wait(self.kafka_stop_timeout_s):
+            self._logger.error(f'Kafka consumer job did not stop in {self.kafka_stop_timeout_s} seconds')
 
     @ServiceBase.route(path='/api/v1/stats', methods=['GET'])
     def _stats(self):
-        return make_response(self._db_connector.get_stat(), 200)
+        if 'from' not in request.args and 'to' not in request.args and 'granularity' not in request.args:
+            return make_response(self._db_connector.get_stat(), 200)
+
+        with UserValue.ErrorChain() as error_chain:
+            from_time = UserValue.get_from(request.args, 'from', error_chain).cast_to(self._parse_utc_time).value
+
+            if 'to' in request.args:
+                to_time = UserValue.get_from(request.args, 'to', error_chain).cast_to(self._parse_utc_time).value
+            else:
+                to_time = datetime.utcnow()
+
+            if 'granularity' in request.args:
+                granularity = UserValue.get_from(request.args, 'granularity', error_chain).rule(self._valid_granularity).value
+            else:
+                granularity = None
+
+        if granularity is None:
+            granularity = self._choose_granularity(to_time - from_time)
+
+        return make_response(self._db_connector.get_stat_buckets(granularity, from_time, to_time), 200)
+
+    @ServiceBase.route(path='/api/v1/stats/latency', methods=['GET'])
+    def _stats_latency(self):
+        return make_response(self._db_connector.get_latency(), 200)
 
     def _register_routes(self):
         self._register_route('_stats')
+        self._register_route('_stats_latency')
+
+    @staticmethod
+    def _valid_granularity(granularity):
+        if granularity not in StatsDbConnector.granularities:
+            return f'granularity must be one of: {", ".join(StatsDbConnector.granularities)}'
+
+        return None
+
+    @staticmethod
+    def _parse_utc_time(value):
+        # buckets are naive UTC timestamps, so aware times are converted and naive ones are taken as UTC
+        parsed = datetime.fromisoformat(value)
+
+        if parsed.tzinfo is not None:
+            parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+
+        return parsed
+
+    @staticmethod
+    def _choose_granularity(duration):
+        if duration <= timedelta(hours=6):
+            return 'minute'
+
+        if duration <= timedelta(days=7):
+            return 'hour'
+
+        return 'day'
+
+    def _render_service_metrics(self, text):
+        worker_stats = [worker.stats() for worker in self._workers]
+
+        for metric, key, description in (
+            ('stats_unknown_routes_total', 'unknownRoutes', 'Request events with an unresolved route id'),
+            ('stats_invalid_methods_total', 'invalidMethods', 'Request events with an invalid method'),
+            ('stats_dropped_events_total', 'droppedEvents', 'Events and rows dropped without being stored')
+        ):
+            text.metric(metric, 'counter', description)
+            text.sample(metric, {'service': self._service_name}, sum(stats[key] for stats in worker_stats))
+
+    def _rollup(self):
+        try:
+            self._db_connector.rollup()
+
+        except Exception as error:
+            self._logger.error(f'Failed to rollup stats: {error}')
+
+    def _on_flushed(self, offsets):
+        with self._committable_lock:
+            for partition, offset in offsets.items():
+                self._committable[partition] = max(offset, self._committable.get(partition, 0))
+
+    def _commit_offsets(self):
+        with self._committable_lock:
+            offsets, self._committable = self._committable, {}
+
+        if len(offsets) == 0:
+            return
+
+        try:
+            self._kafka_consumer.commit(
+                {partition: OffsetAndMetadata(offset, None) for partition, offset in offsets.items()}
+            )
+            self._logger.debug(f'Commit offsets: {offsets}')
+
+        except Exception as error:
+            self._logger.error(f'Failed to commit offsets: {error}')
+
+            self._on_flushed(offsets)
+
+    def _on_partitions_revoked(self, revoked):
+        self._logger.info(f'Partitions revoked: {revoked}')
+
+        if not self._is_running:
+            return
+
+        # uncommitted records are consumed again by the next owner, so a failed flush is dropped, and a flush
+        # still running after the revoke would count them twice, so wait for it however long it takes
+        flushes = [worker.flush(discard_on_error=True) for worker in self._workers]
+
+        for done in flushes:
+            while not done.wait(self._revoke_warning_interval_s):
+                self._logger.warning('Still waiting for a worker to flush before partitions are revoked')
+
+        self._commit_offsets()
+
+    def _get_worker(self, partition):
+        return self._workers[hash((partition.topic, partition.partition)) % len(self._workers)]
 
     def _kafka_job(self):
         self._logger.info('Start kafka consumer job')
-        
-        self._kafka_consumer.assign(
-            [
-                TopicPartition('FlightService', 0),
-                TopicPartition('TicketService', 0),
-                TopicPartition('BounsService', 0),
-                TopicPartition('Gateway', 0)
-            ]
-        )
+
+        for worker in self._workers:
+            worker.start()
+
+        self._kafka_consumer.subscribe(self.topics, listener=StatsRebalanceListener(self))
+
+        last_rollup_time = 0
 
         while self._is_running:
             try:
-                message = self._kafka_consumer.poll(timeout_ms=1000)
+                message = self._kafka_consumer.poll(timeout_ms=min(1000, int(self._flush_interval_s * 1000)))
+
+            except Exception as error:
+                self._logger.error(f'Failed to poll messages: {error}')
+                message = {}
+
+            for partition, records in message.items():
+                self._get_worker(partition).submit(partition, records)
+
+            self._commit_offsets()
+
+            if time.monotonic() - last_rollup_time >= self._rollup_interval_s:
+                self._rollup()
+                last_rollup_time = time.monotonic()
+
+        for worker in self._workers:
+            worker.stop()
+
+        self._commit_offsets()
+        self._kafka_consumer.close(autocommit=False)
+
+        self._logger.info('End kafka consumer job')
+        self._kafka_job_done.set()
 
-                if message == {}:
-                    continue
 
-                for key in message:
-                    service, _ = key
-                    for payload in message[key]:
-                        [method, path] = payload.value.decode('utf-8').split(' ')
+class StatsRebalanceListener(ConsumerRebalanceListener):
+    def __init__(self, service):
+        self._service = service
+
+    def on_partitions_revoked(self, revoked):
+        self._service._on_partitions_revoked(revoked)
+
+    def on_partitions_assigned(self, assigned):
+        self._service._logger.info(f'Partitions assigned: {assigned}')
+
+
+class StatsWorker:
+    def __init__(self, name, db_connector, on_flushed, flush_size=1000, flush_interval_s=1, queue_size=64):
+        self._logger = logging.getLogger(name)
+
+        self._db_connector = db_connector
+        self._on_flushed = on_flushed
+        self._flush_size = flush_size
+        self._flush_interval_s = flush_interval_s
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._decoder = EventDecoder()
+
+        self._batch = StatsBatch()
+        self._offsets = {}
+        self._dropped_events = 0
+
+        self._thread = Thread(target=self._job, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stats(self):
+        return {
+            'unknownRoutes': self._decoder.unknown_routes,
+            'invalidMethods': self._decoder.invalid_methods,
+            'droppedEvents': self._dropped_events
+        }
+
+    def submit(self, partition, records):
+        self._queue.put(('records', partition, records))
+
+    def flush(self, discard_on_error=False):
+        done = Event()
+        self._queue.put(('flush', discard_on_error, done))
+
+        return done
+
+    def stop(self):
+        self._queue.put(('stop', None, None))
+        self._thread.join()
+
+    def _job(self):
+        last_flush_time = time.monotonic()
+
+        while True:
+            try:
+                command, argument, payload = self._queue.get(
+                    timeout=max(self._flush_interval_s - (time.monotonic() - last_flush_time), 0.01)
+                )
+
+            except queue.Empty:
+                command, argument, payload = None, None, None
+
+            if command == 'records':
+                self._add_records(argument, payload)
+
+            if command == 'stop':
+                self._flush()
+                return
+
+            if command == 'flush' or self._batch.events_count >= self._flush_size or \
+                    time.monotonic() - last_flush_time >= self._flush_interval_s:
+                self._flush(discard_on_error=command == 'flush' and argument)
+                last_flush_time = time.monotonic()
+
+            if command == 'flush':
+                payload.set()
+
+    def _add_records(self, partition, records):
+        for record in records:
+            try:
+                if partition.topic == METRICS_TOPIC:
+                    self._batch.add_report(record)
+                else:
+                    self._batch.add_event(partition.topic, record, self._decoder)
 
-                self._db_connector.tick(service, method, path)
             except Exception as error:
                 self._logger.error(f'Failed to parse message: {error}')
 
-        self._logger.info('End kafka consumer job')
+            self._offsets[partition] = record.offset + 1
+
+    def _flush(self, discard_on_error=False):
+        if len(self._offsets) == 0 and self._batch.is_empty():
+            return
+
+        if self._batch.dropped_count != 0:
+            self._logger.warning(f'Drop {self._batch.dropped_count} events with unsupported methods')
+
+            self._dropped_events += self._batch.dropped_count
+            self._batch.dropped_count = 0
+
+        try:
+            if not self._batch.is_empty():
+                try:
+                    self._db_connector.add_batch(self._batch)
+
+                except (psycopg2.DataError, psycopg2.IntegrityError) as error:
+                    self._logger.error(f'Failed to flush stats batch, flush row by row: {error}')
+
+                    self._flush_rows()
+
+                self._logger.debug(f'Flush {self._batch.events_count} events')
+
+        except Exception as error:
+            self._logger.error(f'Failed to flush stats: {error}')
+
+            if not discard_on_error:
+                return
+
+        else:
+            self._on_flushed(self._offsets)
+
+        self._batch = StatsBatch()
+        self._offsets = {}
+
+    def _flush_rows(self):
+        # rows are removed once written, so a connection failure midway retries only the rest
+        for counter_name in ('counts', 'latencies', 'outcomes'):
+            counter = getattr(self._batch, counter_name)
+
+            for key in list(counter):
+                row = StatsBatch()
+                getattr(row, counter_name)[key] = counter[key]
+
+                try:
+                    self._db_connector.add_batch(row)
+
+                except (psycopg2.DataError, psycopg2.IntegrityError) as error:
+                    self._logger.error(f'Drop stats row {key}: {error}')
+
+                    self._dropped_events += counter[key]
+
+                del counter[key]
 
 if __name__ == '__main__':
     tools.set_basic_logging_config()
@@ -114,9 +687,22 @@ if __name__ == '__main__':
     parser.add_argument('--db-user', type=str, required=True)
     parser.add_argument('--db-password', type=str, required=True)
     parser.add_argument('--db-sslmode', type=str, default='disable')
+    parser.add_argument('--db-pool-min', type=int, default=1)
+    parser.add_argument('--db-pool-max', type=int, default=10)
     parser.add_argument('--kafka-host', type=str, default='localhost')
     parser.add_argument('--kafka-port', type=str, default=29092)
+    parser.add_argument('--flush-size', type=int, default=1000)
+    parser.add_argument('--flush-interval', type=float, default=1)
+    parser.add_argument('--rollup-interval', type=float, default=60)
+    parser.add_argument('--kafka-group', type=str, default='StatsService')
+    parser.add_argument('--consumer-workers', type=int, default=4)
+    parser.add_argument('--manage-token', type=str, default=None)
     parser.add_argument('--debug', action='store_true')
+    parser.add_argument('--server', type=str, choices=['flask', 'gunicorn'], default='flask')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--backlog', type=int, default=2048)
+    parser.add_argument('--graceful-timeout', type=int, default=30)
     
     cmd_args = parser.parse_args()
 
@@ -134,9 +720,27 @@ if __name__ == '__main__':
             cmd_args.db,
             cmd_args.db_user,
             cmd_args.db_password,
-            cmd_args.db_sslmode
+            cmd_args.db_sslmode,
+            cmd_args.db_pool_min,
+            cmd_args.db_pool_max
         ),
-        KafkaConsumer(bootstrap_servers=f'{cmd_args.kafka_host}:{cmd_args.kafka_port}')
+        KafkaConsumer(
+            bootstrap_servers=f'{cmd_args.kafka_host}:{cmd_args.kafka_port}',
+            group_id=cmd_args.kafka_group,
+            enable_auto_commit=False
+        ),
+        cmd_args.flush_size,
+        cmd_args.flush_interval,
+        cmd_args.rollup_interval,
+        cmd_args.consumer_workers,
+        manage_token=cmd_args.manage_token
     )
 
-    service.run(cmd_args.debug)
+    service.run(
+        cmd_args.debug,
+        cmd_args.server,
+        cmd_args.workers,
+        cmd_args.threads,
+        cmd_args.backlog,
+        cmd_args.graceful_timeout
+    )
@@ -0,0 +1,110 @@
+from collections import namedtuple
+
+import struct
+import threading
+import time
+import zlib
+
+import routes
+
+EVENT_FORMAT_VERSION = 1
+
+KIND_REQUEST = 0
+KIND_ROUTE = 1
+
+# index 0 is reserved, requests with other methods (HEAD, OPTIONS) are not encoded
+METHODS = ['', 'GET', 'POST', 'DELETE', 'PUT', 'PATCH']
+
+# version, kind, method, route id, timestamp ms, latency us, status
+REQUEST_STRUCT = struct.Struct('>BBBIQIH')
+# version, kind, route id, followed by utf-8 route template
+ROUTE_STRUCT = struct.Struct('>BBI')
+
+RequestEvent = namedtuple('RequestEvent', ['method', 'path', 'timestamp_ms', 'latency_us', 'status'])
+
+
+def route_id_of(path):
+    return zlib.crc32(path.encode('utf-8'))
+
+
+# known routes resolve without an announcement, so a restarted consumer does not drop their events
+ROUTES = {route_id_of(path): path for path in routes.ROUTES}
+
+
+class EventEncoder:
+    def __init__(self, announce_interval_s=60):
+        self._announce_interval_s = announce_interval_s
+
+        self._announced = {}
+        self._lock = threading.Lock()
+
+    def encode(self, method, path, timestamp_ms, latency_us, status):
+        if method not in METHODS[1:]:
+            return None
+
+        route_id = route_id_of(path)
+
+        payloads = []
+
+        now = time.monotonic()
+        with self._lock:
+            if now - self._announced.get(route_id, -self._announce_interval_s) >= self._announce_interval_s:
+                self._announced[route_id] = now
+
+                payloads.append(ROUTE_STRUCT.pack(EVENT_FORMAT_VERSION, KIND_ROUTE, route_id) + path.encode('utf-8'))
+
+        payloads.append(
+            REQUEST_STRUCT.pack(
+                EVENT_FORMAT_VERSION,
+                KIND_REQUEST,
+                METHODS.index(method),
+                route_id,
+                timestamp_ms,
+                min(int(latency_us), 0xffffffff),
+                min(status, 0xffff)
+            )
+        )
+
+        return route_id.to_bytes(4, 'big'), payloads
+
+
+class EventDecoder:
+    def __init__(self):
+        self._routes = {}
+
+        self.unknown_routes = 0
+        self.invalid_methods = 0
+
+    def decode(self, source, payload, timestamp_ms):
+        if len(payload) == 0 or payload[0] != EVENT_FORMAT_VERSION:
+            # plain text 'METHOD PATH' events sent before the binary format
+            [method, path] = payload.decode('utf-8').split(' ')
+
+            return RequestEvent(method, path, timestamp_ms, None, None)
+
+        kind = payload[1]
+
+        if kind == KIND_ROUTE:
+            _, _, route_id = ROUTE_STRUCT.unpack_from(payload)
+            self._routes[(source, route_id)] = payload[ROUTE_STRUCT.size:].decode('utf-8')
+
+            return None
+
+        if kind == KIND_REQUEST:
+            _, _, method, route_id, event_timestamp_ms, latency_us, status = REQUEST_STRUCT.unpack(payload)
+
+            if not 0 < method < len(METHODS):
+                self.invalid_methods += 1
+
+                return None
+
+            path = self._routes.get((source, route_id), ROUTES.get(route_id))
+
+            if path is None:
+                self.unknown_routes += 1
+
+                return None
+
+            return RequestEvent(METHODS[method], path, event_timestamp_ms, latency_us, status)
+
+        raise ValueError(f'unknown event kind {kind}')
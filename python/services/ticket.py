@@ -8,10 +8,20 @@ from flask import make_response
 
 import argparse
 
+from upstream import UpstreamSession
+
 import requests
+import urllib3
 
 import uuid
 import json
+import hashlib
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from cache import TtlLruCache
 
 import tools
 import errors
@@ -21,21 +31,86 @@ from getters import ServerValue
 
 from kafka import KafkaProducer
 
-class TicketDbConnector(DbConnectorBase):
-    def __init__(self, host, port, database, user, password, sslmode='disable'):
-        super().__init__('TicketDbConnector', host, port, database, user, password, sslmode)
+class BonusesNotReturnedError(errors.ServerError):
+    # bonuses stay charged for a ticket that was not sold, so the purchase must not be retried
+    def __init__(self, uid):
+        super().__init__(f'failed to return bonuses for ticket {uid}', 500)
 
-    def get_user_tickets(self, user):
-        query = tools.simplify_sql_query(
-            f'SELECT id, uid, username, flight_number, price, status FROM ticket WHERE username = \'{user}\''
+
+class BonusChargeUnknownError(errors.ServerError):
+    # the charge request may have reached the bonus service, so the purchase must not be retried
+    def __init__(self, uid):
+        super().__init__(f'bonus charge for ticket {uid} has unknown outcome', 500)
+
+
+class TicketDbConnector(DbConnectorBase):
+    migrations = 'tickets'
+
+    statements = {
+        'get_user_tickets': 'SELECT id, uid, username, flight_number, price, status FROM ticket WHERE username = $1',
+        'get_ticket_by_uid': 'SELECT id, uid, username, flight_number, price, status FROM ticket WHERE uid = $1',
+        'add_user_ticket': (
+            'WITH seat AS ( '
+            '    UPDATE flight_seat SET available = available - 1 WHERE flight_number = $3 AND available > 0 '
+            '    RETURNING available '
+            '), inserted AS ( '
+            '    INSERT INTO ticket(username, uid, flight_number, price, status) '
+            '    SELECT $1, $2::uuid, $3, $4::int, $5 FROM seat '
+            ') '
+            'SELECT available FROM seat'
+        ),
+        'cancel_user_ticket': (
+            'WITH canceled AS ( '
+            '    UPDATE ticket SET status = \'CANCELED\' WHERE username = $1 AND uid = $2 AND status = \'PAID\' '
+            '    RETURNING flight_number '
+            ') '
+            'UPDATE flight_seat SET available = LEAST(available + 1, capacity) '
+            'FROM canceled WHERE flight_seat.flight_number = canceled.flight_number'
+        ),
+        'claim_idempotency_key': (
+            'WITH claimed AS ( '
+            '    INSERT INTO idempotency_key(username, key, request_hash, created_at) VALUES($1, $2, $3, now()) '
+            '    ON CONFLICT (username, key) DO UPDATE SET '
+            '        request_hash = EXCLUDED.request_hash, '
+            '        response = NULL, '
+            '        created_at = EXCLUDED.created_at '
+            '    WHERE idempotency_key.created_at < now() - $4::int * interval \'1 second\' '
+            '    RETURNING 1 '
+            ') '
+            'SELECT true, NULL, NULL FROM claimed '
+            'UNION ALL '
+            'SELECT false, request_hash, response FROM idempotency_key '
+            'WHERE username = $1 AND key = $2 AND NOT EXISTS (SELECT 1 FROM claimed)'
+        ),
+        'save_idempotency_response': 'UPDATE idempotency_key SET response = $3::jsonb WHERE username = $1 AND key = $2',
+        'release_idempotency_key': (
+            'DELETE FROM idempotency_key WHERE username = $1 AND key = $2 AND response IS NULL'
+        ),
+        'delete_expired_idempotency_keys': (
+            'DELETE FROM idempotency_key WHERE created_at < now() - $1::int * interval \'1 second\''
+        ),
+        'get_flight_seats': 'SELECT capacity, available FROM flight_seat WHERE flight_number = $1',
+        'sync_flight_seats': (
+            'INSERT INTO flight_seat(flight_number, capacity, available) '
+            '    SELECT $1::varchar, $2::int, GREATEST($2::int - COUNT(1), 0) FROM ticket '
+            '    WHERE flight_number = $1::varchar AND status = \'PAID\' '
+            'ON CONFLICT (flight_number) DO UPDATE SET '
+            '    capacity = EXCLUDED.capacity, '
+            '    available = GREATEST(flight_seat.available + EXCLUDED.capacity - flight_seat.capacity, 0) '
+            'RETURNING available'
         )
+    }
+
+    def __init__(self, host, port, database, user, password, sslmode='disable', pool_min=1, pool_max=10):
+        super().__init__('TicketDbConnector', host, port, database, user, password, sslmode, pool_min, pool_max)
 
-        self._logger.debug(f'Execute query: {query}')
-        cursor = self._connection.cursor()
-        cursor.execute(query)
+    def get_user_tickets(self, user):
+        with self._connection() as connection:
+            cursor = connection.cursor()
+            self._execute(cursor, 'get_user_tickets', (user,))
 
-        table = cursor.fetchall()
-        cursor.close()
+            table = cursor.fetchall()
+            cursor.close()
 
         return [
             {
@@ -50,16 +125,12 @@ class TicketDbConnector(DbConnectorBase):
         ]
 
     def get_ticket_by_uid(self, uid):
-        query = tools.simplify_sql_query(
-            f'SELECT id, uid, username, flight_number, price, status FROM ticket WHERE uid = \'{uid}\''
-        )
+        with self._connection() as connection:
+            cursor = connection.cursor()
+            self._execute(cursor, 'get_ticket_by_uid', (uid,))
 
-        self._logger.debug(f'Execute query: {query}')
-        cursor = self._connection.cursor()
-        cursor.execute(query)
-
-        row = cursor.fetchone()
-        cursor.close()
+            row = cursor.fetchone()
+            cursor.close()
 
         if row is None:
             return None
@@ -74,46 +145,101 @@ class TicketDbConnector(DbConnectorBase):
         }
 
     def add_user_ticket(self, user, uid, flight_number, price, status):
-        query = tools.simplify_sql_query(
-            f'INSERT INTO ticket(username, uid, flight_number, price, status) '
-            f'VALUES(\'{user}\', \'{uid}\', \'{flight_number}\', {price}, \'{status}\')'
-        )
+        with self._connection() as connection:
+            cursor = connection.cursor()
+            self._execute(cursor, 'add_user_ticket', (user, uid, flight_number, price, status))
 
-        self._logger.debug(f'Execute query: {query}')
-        cursor = self._connection.cursor()
-        cursor.execute(query)
+            row = cursor.fetchone()
+            cursor.close()
+            connection.commit()
 
-        cursor.close()
-        self._connection.commit()
+        return row is not None
 
     def cancel_user_ticket(self, user, uid):
-        query = tools.simplify_sql_query(
-            f'UPDATE ticket SET status = \'CANCELED\' WHERE username = \'{user}\' AND uid = \'{uid}\''
-        )
+        with self._connection() as connection:
+            cursor = connection.cursor()
+            self._execute(cursor, 'cancel_user_ticket', (user, uid))
 
-        self._logger.debug(f'Execute query: {query}')
-        cursor = self._connection.cursor()
-        cursor.execute(query)
+            cursor.close()
+            connection.commit()
 
-        cursor.close()
-        self._connection.commit()
+    def claim_idempotency_key(self, user, key, request_hash, ttl_s):
+        with self._connection() as connection:
+            cursor = connection.cursor()
+            self._execute(cursor, 'claim_idempotency_key', (user, key, request_hash, ttl_s))
 
+            row = cursor.fetchone()
+            cursor.close()
+            connection.commit()
 
-    def get_flight_tickets_count(self, flight_number):
-        query = tools.simplify_sql_query(
-            f'SELECT COUNT(1) FROM ticket WHERE flight_number = \'{flight_number}\' and status = \'PAID\''
-        )
-        
-        self._logger.debug(f'Execute query: {query}')
-        cursor = self._connection.cursor()
-        cursor.execute(query)
+        # the key is held by a transaction that has not committed yet
+        if row is None:
+            return None
+
+        return {
+            'claimed': row[0],
+            'request_hash': row[1],
+            'response': row[2]
+        }
+
+    def save_idempotency_response(self, user, key, response):
+        with self._connection() as connection:
+            cursor = connection.cursor()
+            self._execute(cursor, 'save_idempotency_response', (user, key, response))
+
+            cursor.close()
+            connection.commit()
+
+    def release_idempotency_key(self, user, key):
+        with self._connection() as connection:
+            cursor = connection.cursor()
+            self._execute(cursor, 'release_idempotency_key', (user, key))
+
+            cursor.close()
+            connection.commit()
+
+    def delete_expired_idempotency_keys(self, ttl_s):
+        with self._connection() as connection:
+            cursor = connection.cursor()
+            self._execute(cursor, 'delete_expired_idempotency_keys', (ttl_s,))
+
+            cursor.close()
+            connection.commit()
+
+    def get_flight_seats(self, flight_number):
+        with self._connection() as connection:
+            cursor = connection.cursor()
+            self._execute(cursor, 'get_flight_seats', (flight_number,))
+
+            row = cursor.fetchone()
+            cursor.close()
+
+        if row is None:
+            return None
+
+        return {
+            'capacity': row[0],
+            'available': row[1]
+        }
+
+    def sync_flight_seats(self, flight_number, capacity):
+        # first sale of the flight or its capacity changed, the sold seats are counted once here
+        with self._connection() as connection:
+            cursor = connection.cursor()
+            self._execute(cursor, 'sync_flight_seats', (flight_number, capacity))
+
+            row = cursor.fetchone()
+            cursor.close()
+            connection.commit()
 
-        row = cursor.fetchone()
-        cursor.close()
-        
         return row[0]
 
 class TicketService(ServerBaseWithKeycloak):
+    flight_batch_size = 100
+
+    idempotency_key_ttl_s = 3600
+    idempotency_cleanup_interval_s = 60
+
     def __init__(
         self, 
         host, 
@@ -127,7 +253,16 @@ class TicketService(ServerBaseWithKeycloak):
         keycloak_port,
         keycloak_client_id,
         keycloak_client_secret,
-        kafka_producer
+        kafka_producer,
+        flight_fetch_concurrency=16,
+        purchase_concurrency=32,
+        purchase_timeout_s=10,
+        flight_cache_size=1024,
+        flight_cache_ttl_s=300,
+        upstream_pool_size=32,
+        upstream_connect_timeout_s=3,
+        upstream_read_timeout_s=30,
+        manage_token=None
     ):
         super().__init__(
             f'http://{keycloak_host}:{keycloak_port}',
@@ -137,11 +272,35 @@ class TicketService(ServerBaseWithKeycloak):
             host, 
             port, 
             db_connector,
-            kafka_producer
+            kafka_producer,
+            manage_token
+        )
+
+        self._flight_service = UpstreamSession(
+            f'http://{flight_service_host}:{flight_service_port}',
+            upstream_pool_size,
+            upstream_connect_timeout_s,
+            upstream_read_timeout_s
         )
+        self._register_upstream('flight', self._flight_service)
+
+        self._bonus_service = UpstreamSession(
+            f'http://{bonus_service_host}:{bonus_service_port}',
+            upstream_pool_size,
+            upstream_connect_timeout_s,
+            upstream_read_timeout_s
+        )
+        self._register_upstream('bonus', self._bonus_service)
+
+        self._flight_executor = ThreadPoolExecutor(max_workers=flight_fetch_concurrency)
 
-        self._flight_service_url = f'http://{flight_service_host}:{flight_service_port}'
-        self._bonus_service_url = f'http://{bonus_service_host}:{bonus_service_port}'
+        self._purchase_executor = ThreadPoolExecutor(max_workers=purchase_concurrency)
+        self._purchase_timeout_s = purchase_timeout_s
+
+        self._flight_cache = TtlLruCache(flight_cache_size, flight_cache_ttl_s)
+        self._register_cache('flights', self._flight_cache)
+
+        self._last_idempotency_cleanup_time = 0
 
     # API requests handlers
     ####################################################################################################################
@@ -154,27 +313,7 @@ class TicketService(ServerBaseWithKeycloak):
             token = self._get_user_token_from(request)
             username = self._get_username_by(token)
 
-            table = self._db_connector.get_user_tickets(username)
-            
-            meesage = []
-            for row in table:
-                flight = requests.request('GET', f'{self._flight_service_url}/api/v1/flights/{row["flight_number"]}', headers={'Authorization': f'Bearer {token}'}).json()
-                if 'error' in flight.keys():
-                    raise errors.ServerError(flight, 500)
-
-                meesage.append(
-                    {
-                        'ticketUid': row['uid'],
-                        'fromAirport': flight['fromAirport'],
-                        'toAirport': flight['toAirport'],
-                        'date': flight['date'],
-                        'price': row['price'],
-                        'status': row['status'],
-                        'flightNumber': flight['flightNumber']
-                    }
-                )
-
-            return make_response(meesage, 200)
+            return make_response(self._get_user_tickets_with_flights(token, username), 200)
 
         if method == 'POST':
             token = self._get_user_token_from(request)
@@ -188,81 +327,18 @@ class TicketService(ServerBaseWithKeycloak):
                 price = UserValue.get_from(body, 'price', error_chain).expected(int).rule(rules.grater_zero).value
                 paid_from_balance = UserValue.get_from(body, 'paidFromBalance', error_chain).expected(bool).value
  
-            count = self._db_connector.get_flight_tickets_count(flight_number)
-
-            if count >= 3:
-                raise errors.UserError('flight is full', 409)
-
-            flight = self._get_json_from(
-                requests.request(
-                    'GET', 
-                    f'{self._flight_service_url}/api/v1/flights/{flight_number}',
-                    headers={'Authorization': f'Bearer {token}'}
-                )
-            )
-
-            price = ServerValue.get_from(flight, 'price').expected(int).rule(rules.grater_zero).value
-
-            privilege = self._get_json_from(
-                requests.request(
-                    'GET', 
-                    f'{self._bonus_service_url}/api/v1/privilege',
-                    headers={'Authorization': f'Bearer {token}'}
-                )
-            )
-
-            bonus_balance = ServerValue.get_from(privilege, 'balance').expected(int).rule(rules.greate_equal_zero).value
-            
-            if bonus_balance == 0:
-                paid_from_balance = False
-
-            if paid_from_balance:
-                paid_by_bonuses = min(price, bonus_balance)
-                balance_diff = paid_by_bonuses
-            else:
-                paid_by_bonuses = 0
-                balance_diff = int(price / 10)
-                
-            paid_by_money = price - bonus_balance
-
-            uid = str(uuid.uuid4())
-
-            privilege = requests.request(
-                'POST',
-                f'{self._bonus_service_url}/api/v1/privilege/{uid}',
-                headers={
-                    'Content-Type': 'application/json',
-                    'Authorization': f'Bearer {token}'
-                },
-                data=json.dumps({
-                    'paidFromBalance': paid_from_balance,
-                    'datetime': ServerBaseWithKeycloak.get_current_datetime(),
-                    'ticketUid': uid,
-                    'balanceDiff': balance_diff
-                })
-            ).json()
+            if 'Idempotency-Key' not in request.headers:
+                return make_response(self._purchase_ticket(token, username, flight_number, paid_from_balance), 200)
 
-            if 'error' in privilege.keys():
-                return make_response(privilege, 500)
-
-            self._db_connector.add_user_ticket(username, uid, flight_number, price, 'PAID')
+            idempotency_key = UserValue.get_from(request.headers, 'Idempotency-Key').rule(self._valid_idempotency_key).value
 
             return make_response(
-                {
-                    'ticketUid': uid,
-                    'flightNumber': flight_number,
-                    'fromAirport': flight['fromAirport'],
-                    'toAirport': flight['toAirport'],
-                    'date': flight['date'],
-                    'price': price,
-                    'paidByMoney': paid_by_money,
-                    'paidByBonuses': paid_by_bonuses,
-                    'status': 'PAID',
-                    'privilege': {
-                        'balance': privilege['balance'],
-                        'status': privilege['status']
-                    }
-                },
+                self._run_idempotent(
+                    username,
+                    idempotency_key,
+                    request.get_data(),
+                    lambda: self._purchase_ticket(token, username, flight_number, paid_from_balance)
+                ),
                 200
             )
 
@@ -280,9 +356,7 @@ class TicketService(ServerBaseWithKeycloak):
             if ticket is None:
                 raise errors.UserError('non existent ticket', 404)
 
-            url_base = f'{self._flight_service_url}/api/v1/flights'
-
-            flight = requests.request('GET', f'{url_base}/{ticket["flight_number"]}', headers={'Authorization': f'Bearer {token}'}).json()
+            flight = self._get_flights(token, [ticket['flight_number']])[ticket['flight_number']]
 
             return make_response(
                 {
@@ -306,9 +380,9 @@ class TicketService(ServerBaseWithKeycloak):
             if ticket is None:
                 raise errors.UserError('non existent ticket', 404)
 
-            privilege = requests.request(
+            privilege = self._bonus_service.request(
                 'DELETE',
-                f'{self._bonus_service_url}/api/v1/privilege/{uid}',
+                f'/api/v1/privilege/{uid}',
                 headers={
                     'Content-Type': 'application/json',
                     'Authorization': f'Bearer {token}'
@@ -333,31 +407,12 @@ class TicketService(ServerBaseWithKeycloak):
             token = self._get_user_token_from(request)
             username = self._get_username_by(token)
 
-            privilege = requests.request('GET', f'{self._bonus_service_url}/api/v1/privilege', headers={'Authorization': f'Bearer {token}'}).json()
+            privilege = self._bonus_service.request('GET', '/api/v1/privilege', headers={'Authorization': f'Bearer {token}'}).json()
             if 'error' in privilege.keys():
                 raise errors.ServerError(privilege, 500)
 
-            table = self._db_connector.get_user_tickets(username)
-            
-            ticktes = []
-            for row in table:
-                flight = requests.request('GET', f'{self._flight_service_url}/api/v1/flights/{row["flight_number"]}', headers={'Authorization': f'Bearer {token}'}).json()
-                if 'error' in flight.keys():
-                    raise errors.ServerError(flight, 500)
-
-                ticktes.append(
-                    {
-                        'ticketUid': row['uid'],
-                        'fromAirport': flight['fromAirport'],
-                        'toAirport': flight['toAirport'],
-                        'date': flight['date'],
-                        'price': row['price'],
-                        'status': row['status'],
-                        'flightNumber': flight['flightNumber']
-                    }
-                )
             message = {
-                'tickets': ticktes,
+                'tickets': self._get_user_tickets_with_flights(token, username),
                 'privilege': privilege
             }
 
@@ -368,6 +423,312 @@ class TicketService(ServerBaseWithKeycloak):
     # Helpers
     ####################################################################################################################
 
+    def _purchase_ticket(self, token, username, flight_number, paid_from_balance):
+        deadline = time.monotonic() + self._purchase_timeout_s
+
+        # flight, privilege and seats do not depend on each other, only the seats sync needs the flight capacity
+        flight_future = self._purchase_executor.submit(
+            self._request_before,
+            deadline,
+            self._flight_service,
+            'GET',
+            f'/api/v1/flights/{flight_number}',
+            headers={'Authorization': f'Bearer {token}'}
+        )
+        privilege_future = self._purchase_executor.submit(
+            self._request_before,
+            deadline,
+            self._bonus_service,
+            'GET',
+            f'/api/v1/privilege',
+            params={'historySize': 0},
+            headers={'Authorization': f'Bearer {token}'}
+        )
+
+        try:
+            seats = self._db_connector.get_flight_seats(flight_number)
+
+            flight = self._get_json_from(self._wait_before(deadline, flight_future))
+
+            price = ServerValue.get_from(flight, 'price').expected(int).rule(rules.grater_zero).value
+            capacity = ServerValue.get_from(flight, 'capacity').expected(int).rule(rules.greate_equal_zero).value
+
+            if seats is None or seats['capacity'] != capacity:
+                available = self._db_connector.sync_flight_seats(flight_number, capacity)
+            else:
+                available = seats['available']
+
+            if available == 0:
+                raise errors.UserError('flight is full', 409)
+
+            privilege = self._get_json_from(self._wait_before(deadline, privilege_future))
+
+        finally:
+            flight_future.cancel()
+            privilege_future.cancel()
+
+        bonus_balance = ServerValue.get_from(privilege, 'balance').expected(int).rule(rules.greate_equal_zero).value
+        
+        if bonus_balance == 0:
+            paid_from_balance = False
+
+        if paid_from_balance:
+            paid_by_bonuses = min(price, bonus_balance)
+            balance_diff = paid_by_bonuses
+        else:
+            paid_by_bonuses = 0
+            balance_diff = int(price / 10)
+            
+        paid_by_money = price - bonus_balance
+
+        uid = str(uuid.uuid4())
+
+        privilege = self._charge_bonuses(token, uid, paid_from_balance, balance_diff)
+
+        try:
+            added = self._db_connector.add_user_ticket(username, uid, flight_number, price, 'PAID')
+
+        except BaseException:
+            self._return_bonuses(token, uid)
+
+            raise
+
+        if not added:
+            # the last seat was sold after the check, return the bonuses
+            self._return_bonuses(token, uid)
+
+            raise errors.UserError('flight is full', 409)
+
+        return {
+            'ticketUid': uid,
+            'flightNumber': flight_number,
+            'fromAirport': flight['fromAirport'],
+            'toAirport': flight['toAirport'],
+            'date': flight['date'],
+            'price': price,
+            'paidByMoney': paid_by_money,
+            'paidByBonuses': paid_by_bonuses,
+            'status': 'PAID',
+            'privilege': {
+                'balance': privilege['balance'],
+                'status': privilege['status']
+            }
+        }
+
+    def _charge_bonuses(self, token, uid, paid_from_balance, balance_diff):
+        try:
+            response = self._bonus_service.request(
+                'POST',
+                f'/api/v1/privilege/{uid}',
+                headers={
+                    'Content-Type': 'application/json',
+                    'Authorization': f'Bearer {token}'
+                },
+                data=json.dumps({
+                    'paidFromBalance': paid_from_balance,
+                    'datetime': ServerBaseWithKeycloak.get_current_datetime(),
+                    'ticketUid': uid,
+                    'balanceDiff': balance_diff
+                })
+            )
+
+        except Exception as error:
+            if self._is_not_sent(error):
+                raise errors.ServerError('bonus service is unavailable', 503)
+
+            self._logger.error(f'Failed to charge bonuses for ticket {uid}, error: {error}')
+
+            raise BonusChargeUnknownError(uid)
+
+        if 400 <= response.status_code < 500:
+            # the bonus service rejected the request before charging
+            raise errors.UserError(response.json(), response.status_code)
+
+        try:
+            privilege = response.json()
+
+        except ValueError:
+            privilege = None
+
+        if response.status_code != 200 or not isinstance(privilege, dict) or 'error' in privilege.keys():
+            self._logger.error(f'Failed to charge bonuses for ticket {uid}, status: {response.status_code}')
+
+            raise BonusChargeUnknownError(uid)
+
+        return privilege
+
+    @staticmethod
+    def _is_not_sent(error):
+        # only a refused or timed out connect proves that the request never reached the bonus service
+        if isinstance(error, requests.exceptions.ConnectTimeout):
+            return True
+
+        if not isinstance(error, requests.exceptions.ConnectionError) or len(error.args) == 0:
+            return False
+
+        return isinstance(getattr(error.args[0], 'reason', None), urllib3.exceptions.NewConnectionError)
+
+    def _return_bonuses(self, token, uid):
+        try:
+            response = self._bonus_service.request(
+                'DELETE',
+                f'/api/v1/privilege/{uid}',
+                headers={'Authorization': f'Bearer {token}'}
+            )
+
+        except Exception as error:
+            self._logger.error(f'Failed to return bonuses for ticket {uid}, error: {error}')
+
+            raise BonusesNotReturnedError(uid)
+
+        if response.status_code != 200:
+            self._logger.error(f'Failed to return bonuses for ticket {uid}, status: {response.status_code}')
+
+            raise BonusesNotReturnedError(uid)
+
+    @staticmethod
+    def _request_before(deadline, upstream, method, path, **kwargs):
+        timeout_s = deadline - time.monotonic()
+
+        if timeout_s <= 0:
+            raise errors.ServerError(f'{upstream.url} request deadline exceeded', 504)
+
+        return upstream.request(method, path, timeout=timeout_s, **kwargs)
+
+    @staticmethod
+    def _wait_before(deadline, future):
+        try:
+            return future.result(timeout=max(deadline - time.monotonic(), 0))
+
+        except FutureTimeoutError:
+            raise errors.ServerError('purchase deadline exceeded', 504)
+
+    def _run_idempotent(self, username, idempotency_key, request_data, handler):
+        request_hash = hashlib.sha256(request_data).hexdigest()
+
+        self._cleanup_idempotency_keys()
+
+        stored = self._db_connector.claim_idempotency_key(
+            username,
+            idempotency_key,
+            request_hash,
+            self.idempotency_key_ttl_s
+        )
+
+        if stored is None:
+            raise errors.UserError('request with this idempotency key is in progress', 409)
+
+        if not stored['claimed']:
+            if stored['request_hash'] != request_hash:
+                raise errors.UserError('idempotency key is already used for another request', 422)
+
+            if stored['response'] is None:
+                raise errors.UserError('request with this idempotency key is in progress', 409)
+
+            return stored['response']
+
+        # the key stays claimed without a response when the purchase may have charged bonuses that were not
+        # returned, or when its response could not be saved, so a retry gets 409 instead of paying again
+        try:
+            message = handler()
+
+        except (BonusesNotReturnedError, BonusChargeUnknownError):
+            raise
+
+        except BaseException:
+            self._db_connector.release_idempotency_key(username, idempotency_key)
+
+            raise
+
+        self._db_connector.save_idempotency_response(username, idempotency_key, json.dumps(message))
+
+        return message
+
+    def _cleanup_idempotency_keys(self):
+        if time.monotonic() - self._last_idempotency_cleanup_time < self.idempotency_cleanup_interval_s:
+            return
+
+        self._last_idempotency_cleanup_time = time.monotonic()
+
+        try:
+            self._db_connector.delete_expired_idempotency_keys(self.idempotency_key_ttl_s)
+
+        except Exception as error:
+            self._logger.error(f'Failed to delete expired idempotency keys: {error}')
+
+    @staticmethod
+    def _valid_idempotency_key(idempotency_key):
+        if len(idempotency_key) == 0 or len(idempotency_key) > 255:
+            return 'idempotency key length must be from 1 to 255'
+
+        return None
+
+    def _get_flights_batch(self, token, flight_numbers):
+        return self._get_json_from(
+            self._flight_service.request(
+                'GET',
+                f'/api/v1/flights/batch',
+                headers={'Authorization': f'Bearer {token}'},
+                params={'numbers': ','.join(flight_numbers)}
+            )
+        )
+
+    def _get_flights(self, token, flight_numbers):
+        flight_numbers = list(dict.fromkeys(flight_numbers))
+
+        flights = {}
+        missed_numbers = []
+        for flight_number in flight_numbers:
+            flight = self._flight_cache.get(flight_number)
+
+            if flight is None:
+                missed_numbers.append(flight_number)
+            else:
+                flights[flight_number] = flight
+
+        if len(missed_numbers) == 0:
+            return flights
+
+        batches = [
+            missed_numbers[i:i + self.flight_batch_size]
+            for i in range(0, len(missed_numbers), self.flight_batch_size)
+        ]
+
+        for batch in self._flight_executor.map(lambda batch: self._get_flights_batch(token, batch), batches):
+            for flight_number, flight in batch.items():
+                self._flight_cache.put(flight_number, flight)
+
+            flights.update(batch)
+
+        for flight_number in flight_numbers:
+            if flight_number not in flights:
+                raise errors.ServerError(f'non existent flight {flight_number}', 500)
+
+        return flights
+
+    def _get_user_tickets_with_flights(self, token, username):
+        table = self._db_connector.get_user_tickets(username)
+
+        flights = self._get_flights(token, [row['flight_number'] for row in table])
+
+        tickets = []
+        for row in table:
+            flight = flights[row['flight_number']]
+
+            tickets.append(
+                {
+                    'ticketUid': row['uid'],
+                    'fromAirport': flight['fromAirport'],
+                    'toAirport': flight['toAirport'],
+                    'date': flight['date'],
+                    'price': row['price'],
+                    'status': row['status'],
+                    'flightNumber': flight['flightNumber']
+                }
+            )
+
+        return tickets
+
     def _register_routes(self):
         self._register_route('_api_v1_tickets')
         self._register_route('_api_v1_tickets_aUid')
@@ -384,19 +745,37 @@ if __name__ == '__main__':
     parser.add_argument('--flight-service-port', type=int, default=8060)
     parser.add_argument('--bonus-service-host', type=str, default='localhost')
     parser.add_argument('--bonus-service-port', type=int, default=8050)
+    parser.add_argument('--flight-fetch-concurrency', type=int, default=16)
+    parser.add_argument('--purchase-concurrency', type=int, default=32)
+    parser.add_argument('--purchase-timeout', type=float, default=10)
+    parser.add_argument('--flight-cache-size', type=int, default=1024)
+    parser.add_argument('--flight-cache-ttl', type=int, default=300)
+    parser.add_argument('--upstream-pool-size', type=int, default=32)
+    parser.add_argument('--upstream-connect-timeout', type=float, default=3)
+    parser.add_argument('--upstream-read-timeout', type=float, default=30)
     parser.add_argument('--db-host', type=str, default='localhost')
     parser.add_argument('--db-port', type=int, default=5432)
     parser.add_argument('--db', type=str, default='tickets')
     parser.add_argument('--db-user', type=str, required=True)
     parser.add_argument('--db-password', type=str, required=True)
     parser.add_argument('--db-sslmode', type=str, default='disable')
+    parser.add_argument('--db-pool-min', type=int, default=1)
+    parser.add_argument('--db-pool-max', type=int, default=10)
     parser.add_argument('--oidc-host', type=str, default='localhost')
     parser.add_argument('--oidc-port', type=int, default=8030)
     parser.add_argument('--oidc-client-id', type=str, default='ticket-service')
     parser.add_argument('--oidc-client-secret', type=str, required=True)
     parser.add_argument('--kafka-host', type=str, default='localhost')
     parser.add_argument('--kafka-port', type=str, default=29092)
+    parser.add_argument('--kafka-linger-ms', type=int, default=50)
+    parser.add_argument('--kafka-compression', type=str, default='gzip')
+    parser.add_argument('--manage-token', type=str, default=None)
     parser.add_argument('--debug', action='store_true')
+    parser.add_argument('--server', type=str, choices=['flask', 'gunicorn'], default='flask')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--backlog', type=int, default=2048)
+    parser.add_argument('--graceful-timeout', type=int, default=30)
 
     cmd_args = parser.parse_args()
 
@@ -414,7 +793,9 @@ if __name__ == '__main__':
             cmd_args.db,
             cmd_args.db_user,
             cmd_args.db_password,
-            cmd_args.db_sslmode
+            cmd_args.db_sslmode,
+            cmd_args.db_pool_min,
+            cmd_args.db_pool_max
         ),
         cmd_args.flight_service_host,
         cmd_args.flight_service_port,
@@ -424,7 +805,27 @@ if __name__ == '__main__':
         cmd_args.oidc_port,
         cmd_args.oidc_client_id,
         cmd_args.oidc_client_secret,
-        KafkaProducer(bootstrap_servers=f'{cmd_args.kafka_host}:{cmd_args.kafka_port}'),
+        KafkaProducer(
+            bootstrap_servers=f'{cmd_args.kafka_host}:{cmd_args.kafka_port}',
+            linger_ms=cmd_args.kafka_linger_ms,
+            compression_type=cmd_args.kafka_compression
+        ),
+        cmd_args.flight_fetch_concurrency,
+        cmd_args.purchase_concurrency,
+        cmd_args.purchase_timeout,
+        cmd_args.flight_cache_size,
+        cmd_args.flight_cache_ttl,
+        cmd_args.upstream_pool_size,
+        cmd_args.upstream_connect_timeout,
+        cmd_args.upstream_read_timeout,
+        manage_token=cmd_args.manage_token
     )
 
-    service.run(cmd_args.debug)
+    service.run(
+        cmd_args.debug,
+        cmd_args.server,
+        cmd_args.workers,
+        cmd_args.threads,
+        cmd_args.backlog,
+        cmd_args.graceful_timeout
+    )
@@ -0,0 +1,104 @@
+import requests
+from requests.adapters import HTTPAdapter
+
+import threading
+import time
+
+from metrics import TimingMetrics
+
+
+class UpstreamSession:
+    def __init__(self, url, pool_size=32, connect_timeout_s=3, read_timeout_s=30):
+        self.url = url
+
+        self._adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+
+        self._session = requests.Session()
+        self._session.mount('http://', self._adapter)
+        self._session.mount('https://', self._adapter)
+
+        self._timeout = (connect_timeout_s, read_timeout_s)
+        self._pool_size = pool_size
+
+        self._lock = threading.Lock()
+
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.total_time_s = 0.0
+
+        self.timings = TimingMetrics()
+
+    def request(self, method, path, **kwargs):
+        kwargs.setdefault('timeout', self._timeout)
+
+        with self._lock:
+            self.in_flight += 1
+
+        start_time = time.monotonic()
+
+        try:
+            return self._session.request(method, f'{self.url}{path}', **kwargs)
+
+        except Exception:
+            with self._lock:
+                self.errors += 1
+
+            raise
+
+        finally:
+            duration_s = time.monotonic() - start_time
+
+            with self._lock:
+                self.in_flight -= 1
+                self.requests += 1
+                self.total_time_s += duration_s
+
+            self.timings.record(method, duration_s)
+
+    def stats(self):
+        opened_connections = 0
+        for key in list(self._adapter.poolmanager.pools.keys()):
+            pool = self._adapter.poolmanager.pools.get(key)
+
+            if pool is not None:
+                opened_connections += pool.num_connections
+
+        with self._lock:
+            return {
+                'url': self.url,
+                'poolSize': self._pool_size,
+                'openedConnections': opened_connections,
+                'inFlight': self.in_flight,
+                'requests': self.requests,
+                'errors': self.errors,
+                'totalTime': self.total_time_s
+            }
+
+
+class ServiceInfo:
+    def __init__(self, url, pool_size=32, connect_timeout_s=3, read_timeout_s=30):
+        self.url = url
+        self.session = UpstreamSession(url, pool_size, connect_timeout_s, read_timeout_s)
+        self.queue = []
+        self.error_level = 0
+        self.last_error_time = 0
+
+    def on_success(self):
+        self.error_level = 0
+
+    def on_failure(self, valid_error_level):
+        self.error_level = min(self.error_level, valid_error_level) + 1
+        self.last_error_time = int(time.time())
+
+    def is_circuit_open(self, valid_error_level, wait_before_retry):
+        return self.error_level > valid_error_level and self.last_error_time + wait_before_retry > int(time.time())
+
+
+class RequestBackup:
+    def __init__(self, path, method, headers, args, data):
+        self.path = path
+        self.method = method
+        self.headers = headers
+        self.args = args
+        self.data = data
@@ -0,0 +1,95 @@
+import argparse
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import requests
+from kafka import KafkaProducer
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'services'))
+
+import tools
+from base import ServiceBase
+
+
+def serve(cmd_args):
+    # api_version skips the broker version probe, so the producer is created without a running kafka
+    kafka_producer = KafkaProducer(
+        bootstrap_servers=[f'{cmd_args.kafka_host}:{cmd_args.kafka_port}'],
+        api_version=(2, 0),
+        linger_ms=50,
+        compression_type='gzip'
+    )
+
+    ServiceBase('smoke', cmd_args.host, cmd_args.port, kafka_producer=kafka_producer).run(
+        server='gunicorn',
+        workers=1,
+        threads=2,
+        graceful_timeout_s=1
+    )
+
+
+def check(cmd_args):
+    logger = logging.getLogger('smoke')
+
+    process = subprocess.Popen(
+        [
+            sys.executable, os.path.abspath(__file__), '--serve',
+            '--host', cmd_args.host,
+            '--port', str(cmd_args.port),
+            '--kafka-host', cmd_args.kafka_host,
+            '--kafka-port', str(cmd_args.kafka_port)
+        ]
+    )
+
+    url = f'http://{cmd_args.host}:{cmd_args.port}'
+
+    try:
+        deadline = time.monotonic() + cmd_args.timeout
+
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f'gunicorn exited with code {process.returncode}')
+
+            try:
+                health = requests.get(f'{url}/manage/health', timeout=1)
+                metrics = requests.get(f'{url}/manage/metrics', timeout=1)
+
+                # the metrics reporter and event emitter are rebuilt in the worker after fork
+                if health.status_code == 200 and 'event_queue_depth' in metrics.text:
+                    logger.info(f'gunicorn worker is up on {url}')
+
+                    return
+
+            except requests.exceptions.ConnectionError:
+                pass
+
+            time.sleep(0.2)
+
+        raise RuntimeError(f'gunicorn worker did not become healthy in {cmd_args.timeout} seconds')
+
+    finally:
+        process.send_signal(signal.SIGTERM)
+        process.wait()
+
+
+if __name__ == '__main__':
+    tools.set_basic_logging_config(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='boot one gunicorn worker of a service and check it answers')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--kafka-host', type=str, default='localhost')
+    parser.add_argument('--kafka-port', type=int, default=29092)
+    parser.add_argument('--timeout', type=float, default=20)
+    parser.add_argument('--serve', action='store_true')
+
+    cmd_args = parser.parse_args()
+
+    if cmd_args.serve:
+        serve(cmd_args)
+    else:
+        check(cmd_args)